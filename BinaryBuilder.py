@@ -7,41 +7,88 @@ import inspect
 import os
 import os.path as P
 import platform
+import select
+import socket
+import stat
 import subprocess
 import sys
 import logging
+import tarfile
+import threading
+import atexit
 import copy, re
+import zipfile
+import json
+import tempfile
+import time
+import random
 
 if sys.version_info < (3, 0, 0):
     # Python 2
-    from urllib2 import urlopen
+    from urllib2 import urlopen, Request, HTTPError, URLError
     from urlparse import urlparse
+    string_types = basestring
 else:
     # Python 3
-    from urllib.request import urlopen
+    from urllib.request import urlopen, Request
+    from urllib.error import HTTPError, URLError
     from urllib.parse import urlparse
+    string_types = str
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    # Python 2
+    from collections import MutableMapping
+from hashlib import sha1
 from functools import wraps, partial
+from fnmatch import fnmatch
 from glob import glob
+import shutil
 from shutil import rmtree
 
-from BinaryDist import which, mkdir_f, get_platform, run, hash_file
+from BinaryDist import which, mkdir_f, get_platform, run, hash_file, remember_hash
+from BuildLog import StageLog
+from InstallManifest import installing, snapshot as install_snapshot
 
 global logger
 logger = logging.getLogger()
 
 # Replace a line in a file with another
 def replace_line_in_file(filename, line_in, line_out):
+    # Write a new file and move it in place, rather than writing over the
+    # old one, so it is never left cut short and never changes a copy in
+    # the source cache it shares its blocks with or is hardlinked to.
     lines = []
     with open(filename,'r') as f:
         lines = f.readlines()
-    with open(filename,'w') as f:
+    fd, tmp = tempfile.mkstemp(dir=P.dirname(P.abspath(filename)), prefix='.tmp-')
+    with os.fdopen(fd, 'w') as f:
         for line in lines:
             line = line.rstrip('\n')
             if line == line_in:
                 line = line_out
             f.write( line + '\n')
+    shutil.copymode(filename, tmp)
+    os.rename(tmp, filename)
+
+def write_if_changed(filename, content):
+    '''Write content to filename, unless it has that content already, in
+       which case it is left alone with its modification time. The file
+       is replaced at once, so readers never see a partial one.'''
+    try:
+        with open(filename) as f:
+            if f.read() == content:
+                return False
+    except IOError:
+        pass
+    fd, tmp = tempfile.mkstemp(dir=P.dirname(P.abspath(filename)), prefix='.tmp-')
+    with os.fdopen(fd, 'w') as f:
+        f.write(content)
+    os.chmod(tmp, 0o644)
+    os.rename(tmp, filename)
+    return True
 
 class PackageError(Exception):
     def __init__(self, pkg, message):
@@ -132,23 +179,202 @@ def die(*args, **kw):
     error(*args, **kw)
     sys.exit(kw.get('code', -1))
 
+# The stage being run by each thread, if its stats are being recorded
+_current_stage = threading.local()
+_stats_lock = threading.Lock()
+
+class StageStats(object):
+    '''Resources used by one stage of a package. The cpu time and memory
+       are those of the commands the stage ran, which are added as they
+       finish, so that packages built at the same time don't get counted
+       in each other's stages. The install and restore stages also count
+       how much the package added to INSTALL_DIR, from the snapshots the
+       InstallManifest is made from.'''
+    def __init__(self, pkg, stage):
+        self.pkg   = pkg
+        self.stage = stage
+        self.user  = 0.0
+        self.sys   = 0.0
+        self.maxrss = 0
+        self.recording = None
+        if stage in ('install', 'restore'):
+            self.recording = getattr(_current_stage, 'recording', None)
+        self.retries    = 0
+        self.retry_wait = 0.0
+        self.cc_counters = None
+        if _compiler_cache is not None and stage in ('configure', 'compile', 'install'):
+            self.cc_counters = _compiler_cache.counters(pkg.env)
+        self.start = time.time()
+
+    def add(self, usage):
+        '''Account for the resource.struct_rusage of a finished command'''
+        self.user += usage.ru_utime
+        self.sys  += usage.ru_stime
+        maxrss = usage.ru_maxrss
+        if sys.platform == 'darwin':
+            maxrss //= 1024 # bytes there, kilobytes elsewhere
+        self.maxrss = max(self.maxrss, maxrss)
+
+    def finish(self, ok):
+        '''Append the stats of the stage to the STATS_FILE of the environment'''
+        end = time.time()
+        record = dict(
+            run          = self.pkg.env.get('STATS_RUN', ''),
+            package      = self.pkg.pkgname,
+            stage        = self.stage,
+            ok           = ok,
+            start        = round(self.start, 3),
+            end          = round(end, 3),
+            wall         = round(end - self.start, 3),
+            user         = round(self.user, 3),
+            sys          = round(self.sys, 3),
+            maxrss_kb    = self.maxrss,
+        )
+        if self.recording is not None:
+            record['install_bytes'] = self.recording.install_bytes()
+        if self.retries:
+            record['retries']    = self.retries
+            record['retry_wait'] = round(self.retry_wait, 3)
+        if self.cc_counters is not None:
+            hits, misses = _compiler_cache.counters(self.pkg.env)
+            record['cc_hits']   = hits   - self.cc_counters[0]
+            record['cc_misses'] = misses - self.cc_counters[1]
+        line = json.dumps(record, sort_keys=True)
+        with _stats_lock:
+            with open(self.pkg.env['STATS_FILE'], 'a') as f:
+                f.write(line + '\n')
+
 def stage(f):
     '''Wraps a function to provide some standard output formatting.
-       Only compatible with the Package class!'''
+       Only compatible with the Package class!
+       If the environment has a STATS_FILE, the time and resources used
+       by the stage are appended to it. If it has a LOG_DIR, the output of
+       the commands of the stage goes to a StageLog there instead of the
+       console. Stages called from within another stage (say, a compile
+       calling the compile of its base class) are accounted and logged in
+       the outer one.'''
     @wraps(f)
     def wrapper(self, *args, **kw):
         stage = f.__name__
         info('========== %s.%s ==========' % (self.pkgname, stage))
+        stats = None
+        if getattr(_current_stage, 'stats', None) is None and self.env.get('STATS_FILE'):
+            stats = StageStats(self, stage)
+            _current_stage.stats = stats
+        log = None
+        if getattr(_current_stage, 'log', None) is None and self.env.get('LOG_DIR'):
+            log = StageLog(self.env['LOG_DIR'], self.pkgname, stage)
+            _current_stage.log = log
+        ok = False
         try:
-            return f(self, *args, **kw)
+            ret = f(self, *args, **kw)
+            ok = True
+            return ret
         except HelperError as e:
             raise PackageError(self, 'Stage[%s] %s' % (stage,e))
+        finally:
+            if stats is not None:
+                _current_stage.stats = None
+                stats.finish(ok)
+            if log is not None:
+                _current_stage.log = None
+                log.close()
+    return wrapper
+
+_created_dirs = set()
+_created_dirs_lock = threading.Lock()
+
+class RetryPolicy(object):
+    '''How the stages which talk to servers (fetch, git ls-remote, svn
+       checkout) try again when that fails: up to "attempts" times, waiting
+       "delay" seconds after the first failure, "factor" times longer after
+       each of the next ones, up to max_delay. Each wait is cut by a random
+       amount of up to "jitter" of it, so that builds running at the same
+       time don't all come back at once. The stages which build are never
+       tried again, their failures are not going to go away.'''
+
+    def __init__(self, attempts=5, delay=10.0, factor=2.0, max_delay=300.0, jitter=0.5):
+        self.attempts  = max(attempts, 1)
+        self.delay     = delay
+        self.factor    = factor
+        self.max_delay = max_delay
+        self.jitter    = jitter
+
+    def wait_time(self, failures):
+        '''Seconds to wait after this many failures'''
+        wait = min(self.delay * self.factor ** (failures - 1), self.max_delay)
+        return wait * (1.0 - self.jitter * random.random())
+
+    # The errors of talking to servers, which may go away when tried again.
+    # get() and the commands run by helper() fail with HelperError.
+    TRANSIENT = (HelperError, URLError, socket.timeout, socket.gaierror)
+    # The other socket errors, which are IOError or OSError like those of
+    # the local disk, by errno
+    TRANSIENT_ERRNOS = frozenset(getattr(errno, name) for name in
+                                 ('ECONNRESET', 'ECONNREFUSED', 'ECONNABORTED', 'ETIMEDOUT',
+                                  'EHOSTUNREACH', 'EHOSTDOWN', 'ENETUNREACH', 'ENETDOWN',
+                                  'ENETRESET', 'EPIPE')
+                                 if hasattr(errno, name))
+
+    def transient(self, e):
+        '''Whether the error e may go away when tried again'''
+        if isinstance(e, self.TRANSIENT):
+            return True
+        return isinstance(e, (IOError, OSError)) and e.errno in self.TRANSIENT_ERRNOS
+
+    def call(self, func, what):
+        '''Call func until it does not raise, or the attempts run out.
+           Only the transient errors are retried: the errors of the package
+           itself (PackageError), of the local disk (full, not writable)
+           or of our own code are raised at once. The retries and the
+           time waited are added to the stats of the current stage.'''
+        for attempt in range(1, self.attempts + 1):
+            try:
+                return func()
+            except Exception as e:
+                if attempt == self.attempts or not self.transient(e):
+                    raise
+                wait = self.wait_time(attempt)
+                info('%s failed (attempt %d of %d), trying again in %.0f seconds: %s' %
+                     (what, attempt, self.attempts, wait, e))
+                stats = getattr(_current_stage, 'stats', None)
+                if stats is not None:
+                    stats.retries    += 1
+                    stats.retry_wait += wait
+                time.sleep(wait)
+
+_retry_policy = RetryPolicy()
+
+def set_retry_policy(policy):
+    '''Make the network stages of all packages retry with this RetryPolicy'''
+    global _retry_policy
+    _retry_policy = policy
+
+def retried(f):
+    '''Wraps a Package method which talks to servers, so it is tried again
+       according to the RetryPolicy. Goes under @stage, so the retries are
+       counted in the stage.'''
+    @wraps(f)
+    def wrapper(self, *args, **kw):
+        return _retry_policy.call(lambda: f(self, *args, **kw),
+                                  '%s.%s' % (self.pkgname, f.__name__))
     return wrapper
 
-class Environment(dict):
-    '''Dictionary object containing the required environment info'''
+class Environment(MutableMapping):
+    '''Dictionary object containing the required environment info.
+
+       Copies are layered: a copy shares a snapshot of the values of the
+       environment it was made from and keeps only the values set on it
+       (or deleted from it). Changing either one afterwards doesn't change
+       the other. flat() gives all the values as a plain dict, for
+       subprocesses, made again only after something changed.'''
+    _DELETED = object()
+
     def __init__(self, **kw):
         '''Constructor requires several directory paths to be specified'''
+        self._base = {}
+        self._own  = {}
+        self._flat = None
         self.update(dict(
             HOME           = kw['BUILD_DIR'],
             DOWNLOAD_DIR   = kw['DOWNLOAD_DIR'],
@@ -163,22 +389,87 @@ class Environment(dict):
         self.create_dirs()
 
     def create_dirs(self):
-        '''Create all required directories'''
-        for d in ('DOWNLOAD_DIR', 'BUILD_DIR', 'INSTALL_DIR'):
-            try:
-                os.makedirs(self[d])
-            except OSError as o:
-                if o.errno != errno.EEXIST: # Don't care if it already exists
-                    raise
+        '''Create all required directories, once per process'''
+        dirs = tuple(self[d] for d in ('DOWNLOAD_DIR', 'BUILD_DIR', 'INSTALL_DIR'))
+        with _created_dirs_lock:
+            if dirs in _created_dirs:
+                return
+            for d in dirs:
+                try:
+                    os.makedirs(d)
+                except OSError as o:
+                    if o.errno != errno.EEXIST: # Don't care if it already exists
+                        raise
+            _created_dirs.add(dirs)
+
+    def flat(self):
+        '''All the values as a dict. It is shared with the copies made from
+           this environment, so it must not be changed.'''
+        if self._flat is None:
+            if not self._own:
+                self._flat = self._base
+            else:
+                flat = dict(self._base)
+                for k, v in self._own.items():
+                    if v is self._DELETED:
+                        flat.pop(k, None)
+                    else:
+                        flat[k] = v
+                self._flat = flat
+        return self._flat
+
+    def __getitem__(self, key):
+        value = self._own.get(key, self._DELETED)
+        if value is self._DELETED:
+            if key in self._own:
+                raise KeyError(key)
+            return self._base[key]
+        return value
+
+    def __setitem__(self, key, value):
+        self._own[key] = value
+        self._flat = None
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._own[key] = self._DELETED
+        self._flat = None
+
+    def __contains__(self, key):
+        value = self._own.get(key, self._DELETED)
+        if value is self._DELETED:
+            return key not in self._own and key in self._base
+        return True
+
+    def __iter__(self):
+        return iter(self.flat())
+
+    def __len__(self):
+        return len(self.flat())
+
+    def __repr__(self):
+        return repr(self.flat())
+
+    def clear(self):
+        self._base = {}
+        self._own  = {}
+        self._flat = None
 
     def copy_set_default(self, **kw):
         '''Create a copy of this object with default values provided in case they are missing'''
-        e = Environment(**self) # Create copy of this object
+        e = Environment.__new__(Environment) # Create copy of this object
+        e._base = self.flat()
+        e._own  = {}
+        e._flat = None
         for k,v in kw.items():
             if k not in e:
                 e[k] = v
         return e
 
+    def __deepcopy__(self, memo):
+        return self.copy_set_default() # The values are all strings
+
     def append(self, key, value):
         '''Safely append the value to a list of entries with the given key'''
         if key in self:
@@ -203,8 +494,12 @@ def unique_compiler_flags(iflags):
             oflags.append(keyword)
     return " ".join(oflags)
 
-def get(url, output=None):
-    '''Fetch a file from a url and write to "output"'''
+def get(url, output=None, resume=True, attempts=3):
+    '''Fetch a file from a url and write to "output". Returns the sha1 of
+       the file, computed as it is written. The data goes to output.part
+       first, and if that is there from an earlier, interrupted download,
+       only the rest of the file is asked for (for http urls). A connection
+       lost midway is resumed the same way, up to "attempts" times.'''
     # Provide a default output path
     if output is None:
         output = P.basename(urlparse(url).path)
@@ -212,34 +507,660 @@ def get(url, output=None):
     else:
         base = P.basename(output)
 
+    # When several downloads run at once, their progress lines would
+    # overwrite each other, so only say when each starts and ends.
+    with _downloads_lock:
+        _downloads[0] += 1
+    try:
+        part = output + '.part'
+        if not resume and P.exists(part):
+            os.remove(part)
+        for attempt in range(attempts):
+            try:
+                digest = _get(url, part, base)
+                break
+            except _Interrupted as e:
+                if attempt == attempts - 1:
+                    raise HelperError('urlopen', {}, '%s: %s' % (url, e))
+                warn('Download of %s was interrupted, resuming: %s' % (base, e))
+        os.rename(part, output)
+        return digest
+    finally:
+        with _downloads_lock:
+            _downloads[0] -= 1
+
+_downloads = [0] # How many get() calls are running
+_downloads_lock = threading.Lock()
+
+class _Interrupted(Exception):
+    '''The connection went away in the middle of a download'''
+
+def _get(url, output, base):
+    '''Download url to output, resuming at the end of output if it is
+       there. Returns the sha1 of the whole file.'''
     # Read from the URL and write to the output file in blocks
-    BLOCK_SIZE = 16384
-    with open(output, 'wb') as f:
-        try:
-            # Bypass verification to deal with the issue
-            # of bad certificate on some machines
-            import ssl
-            context = ssl._create_unverified_context()
-            r = urlopen(url, context=context)
-        except Exception as e:
-            print("Failed to get: " + url + ", error was: " + str(e))
-            raise HelperError('urlopen', None, '%s: %s' % (url, e))
+    BLOCK_SIZE = 65536
+    quiet = _downloads[0] > 1
+
+    # Pick up the checksum where the partial download left it
+    h = sha1()
+    current = 0
+    if P.exists(output) and urlparse(url).scheme in ('http', 'https'):
+        with open(output, 'rb') as f:
+            for block in iter(partial(f.read, 1 << 20), b''):
+                h.update(block)
+                current += len(block)
+    headers = {}
+    if current > 0:
+        headers['Range'] = 'bytes=%d-' % current
 
-        current = 0
-        size = int(r.info().get('Content-Length', -1))
-        
+    try:
+        # Bypass verification to deal with the issue
+        # of bad certificate on some machines
+        import ssl
+        context = ssl._create_unverified_context()
+        r = urlopen(Request(url, headers=headers), context=context)
+    except HTTPError as e:
+        if e.code == 416 and current > 0:
+            # What we have is no prefix of the file, start over
+            os.remove(output)
+            return _get(url, output, base)
+        print("Failed to get: " + url + ", error was: " + str(e))
+        raise HelperError('urlopen', {}, '%s: %s' % (url, e))
+    except Exception as e:
+        print("Failed to get: " + url + ", error was: " + str(e))
+        raise HelperError('urlopen', {}, '%s: %s' % (url, e))
+
+    mode = 'ab'
+    if current > 0:
+        content_range = r.info().get('Content-Range', '')
+        if getattr(r, 'status', r.getcode()) != 206 or \
+               not content_range.startswith('bytes %d-' % current):
+            # The server sent the whole file
+            h = sha1()
+            current = 0
+    if current == 0:
+        mode = 'wb'
+    elif not quiet:
+        info('Resuming %s at %i kB' % (base, current/1024.))
+
+    size = int(r.info().get('Content-Length', -1))
+    if size >= 0:
+        size += current
+    if quiet:
+        info('Downloading %s' % base)
+
+    with open(output, mode) as f:
         while True: # Download until we run out of data
-            block = r.read(BLOCK_SIZE)
+            try:
+                block = r.read(BLOCK_SIZE)
+            except Exception as e:
+                raise _Interrupted(e)
             if not block:
                 break # Block read failed or completed
+            h.update(block)
             current += len(block)
-            if size < 0: # Unknown size
+            if quiet:
+                pass
+            elif size < 0: # Unknown size
                 info('\rDownloading %s: %i kB' % (base, current/1024.), end='')
             else: # Known size
                 info('\rDownloading %s: %i / %i kB (%0.2f%%)' % (base, current/1024., size/1024., current*100./size), end='')
             f.write(block) # Write to disk
+    if size >= 0 and current < size:
+        raise _Interrupted('got %d of %d bytes' % (current, size))
+    if quiet:
+        info('Done downloading %s' % base)
+    else:
         info('\nDone')
-        
+    return h.hexdigest()
+
+# Programs to decompress archives to stdout, the parallel ones first
+DECOMPRESSORS = (
+    (('.gz', '.tgz'),           (('pigz', '-dc'), ('gzip', '-dc'))),
+    (('.Z',),                   (('gzip', '-dc'),)),
+    (('.bz2', '.tbz', '.tbz2'), (('lbzip2', '-dc'), ('pbzip2', '-dc'), ('bzip2', '-dc'))),
+    (('.xz', '.txz'),           (('xz', '-T0', '-dc'),)), # xz >= 5.4 decompresses in parallel
+    (('.zst', '.tzst'),         (('zstd', '-T0', '-dc'),)),
+)
+
+def _excluded(name, exclude):
+    '''Whether an archive member is left out. The patterns are matched
+       against the path below the top-level directory, like "doc/*", one
+       path component at a time, so a * does not match a /. A pattern
+       matching a directory matches all that is in it. The last pattern
+       that matches wins, and a leading ! keeps what it matches.'''
+    parts = name.split('/', 1)
+    if len(parts) < 2 or not parts[1]:
+        return False # Never drop the top-level directory itself
+    path = parts[1].rstrip('/').split('/')
+    skip = False
+    for pattern in exclude:
+        keep = pattern.startswith('!')
+        components = pattern.lstrip('!').split('/')
+        if len(components) <= len(path) and \
+               all(fnmatch(p, c) for p, c in zip(path, components)):
+            skip = not keep
+    return skip
+
+def _extract_tar(tar, output_dir, exclude):
+    '''Extract a tarfile opened in stream mode, in one pass. Returns the
+       names of the top-level entries.'''
+    kw = {}
+    if hasattr(tarfile, 'fully_trusted_filter'):
+        kw['filter'] = 'fully_trusted' # Our sources are checksummed
+    top  = set()
+    dirs = []
+    for member in tar:
+        name = member.name
+        while name.startswith('./'):
+            name = name[2:]
+        if not name or name == '.':
+            continue
+        member.name = name
+        if _excluded(name, exclude):
+            continue
+        if member.islnk() and _excluded(member.linkname, exclude):
+            continue
+        top.add(name.split('/', 1)[0])
+        if member.isdir():
+            # Make sure we can write into it until we are done
+            dirs.append((name, member.mode, member.mtime))
+            member.mode |= 0o700
+        tar.extract(member, output_dir, **kw)
+    for name, mode, mtime in reversed(dirs):
+        path = P.join(output_dir, name)
+        try:
+            os.chmod(path, mode)
+            os.utime(path, (mtime, mtime))
+        except OSError:
+            pass
+    return top
+
+def _extract_zip(archive, output_dir, exclude):
+    '''Extract a zip file, keeping the permissions and symlinks, which
+       zipfile itself drops. Returns the names of the top-level entries.'''
+    top = set()
+    with zipfile.ZipFile(archive) as z:
+        for info_ in z.infolist():
+            name = info_.filename
+            if _excluded(name.rstrip('/'), exclude):
+                continue
+            top.add(name.split('/', 1)[0])
+            mode = info_.external_attr >> 16
+            path = P.join(output_dir, name)
+            if stat.S_ISLNK(mode):
+                mkdir_f(P.dirname(path))
+                os.symlink(z.read(info_).decode('utf-8'), path)
+                continue
+            z.extract(info_, output_dir)
+            if mode and not name.endswith('/'):
+                os.chmod(path, stat.S_IMODE(mode))
+    return top
+
+def unpack_archive(archive, output_dir, exclude=()):
+    '''Extract a tar or zip archive into output_dir, reading it only once.
+       Compressed tarballs are streamed from the fastest decompressor
+       available (pigz, lbzip2, xz -T0, ...) straight into the extraction,
+       so decompression runs on other cores. Members matching the exclude
+       patterns are skipped. Returns the names of the top-level entries
+       of the archive, so the caller knows its directory without looking.'''
+    mkdir_f(output_dir)
+    if archive.endswith('.zip'):
+        return sorted(_extract_zip(archive, output_dir, exclude))
+
+    cmd = None
+    for exts, programs in DECOMPRESSORS:
+        if archive.endswith(exts):
+            for program in programs:
+                if which(program[0]) is not None:
+                    cmd = list(program) + [archive]
+                    break
+            break
+
+    if cmd is None:
+        # Plain tar, or no decompressor around: let tarfile do it
+        with tarfile.open(archive, 'r|*') as tar:
+            return sorted(_extract_tar(tar, output_dir, exclude))
+
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=1 << 20)
+    try:
+        with tarfile.open(fileobj=p.stdout, mode='r|') as tar:
+            top = _extract_tar(tar, output_dir, exclude)
+        # Read what is left (tar padding), so the decompressor exits cleanly
+        while p.stdout.read(1 << 16):
+            pass
+    except:
+        p.kill()
+        p.wait()
+        raise
+    finally:
+        p.stdout.close()
+    if p.wait() != 0:
+        raise HelperError(cmd[0], {}, 'Failed to decompress %s: return code %d' % (archive, p.returncode))
+    return sorted(top)
+
+def clone_tree(src, dst, link=False):
+    '''Copy the directory src to dst, which must not exist yet. Where the
+       file system can do it (btrfs, xfs, APFS), the files are cloned with
+       copy-on-write, which takes next to no time or space, and a build
+       changing them doesn't change the originals. Elsewhere, with link,
+       the files are hardlinked instead, so they are shared until replaced:
+       see break_link().'''
+    if sys.platform.startswith('linux'):
+        cmd = ['cp', '-a', '--reflink=always', src, dst]
+    elif sys.platform == 'darwin':
+        cmd = ['cp', '-a', '-c', src, dst]
+    else:
+        cmd = None
+    if cmd is not None and which('cp') is not None:
+        with open(os.devnull, 'w') as null:
+            if subprocess.call(cmd, stderr=null) == 0:
+                return
+        if P.exists(dst):
+            rmtree(dst)
+    if link:
+        try:
+            _link_tree(src, dst)
+            return
+        except OSError:
+            # Not on the same file system
+            if P.exists(dst):
+                rmtree(dst)
+    shutil.copytree(src, dst, symlinks=True)
+
+def _link_tree(src, dst):
+    '''Make dst a copy of the directory src with hardlinks to its files'''
+    for dirname, dirs, files in os.walk(src):
+        target = dst if dirname == src else P.join(dst, P.relpath(dirname, src))
+        os.mkdir(target)
+        shutil.copystat(dirname, target)
+        for name in files + [d for d in dirs if P.islink(P.join(dirname, d))]:
+            path = P.join(dirname, name)
+            if P.islink(path):
+                os.symlink(os.readlink(path), P.join(target, name))
+            else:
+                os.link(path, P.join(target, name))
+
+def break_link(filename):
+    '''Give filename a file of its own, if it is hardlinked to another one,
+       as the sources taken from the source cache may be, so it can be
+       written in place without changing the other.'''
+    try:
+        st = os.lstat(filename)
+    except OSError:
+        return
+    if st.st_nlink < 2 or not stat.S_ISREG(st.st_mode):
+        return
+    fd, tmp = tempfile.mkstemp(dir=P.dirname(P.abspath(filename)), prefix='.tmp-')
+    os.close(fd)
+    shutil.copy2(filename, tmp)
+    os.rename(tmp, filename)
+
+# Servers which carry the same files under different url prefixes. A
+# source whose url starts with one of the prefixes in a group can also be
+# fetched from the others.
+MIRRORS = [
+    ('http://ftp.gnu.org/gnu/', 'ftp://ftp.gnu.org/gnu/', 'https://ftp.gnu.org/gnu/',
+     'http://ftpmirror.gnu.org/', 'https://ftpmirror.gnu.org/', 'https://mirrors.kernel.org/gnu/'),
+    ('http://download.savannah.nongnu.org/releases/', 'http://download-mirror.savannah.gnu.org/releases/'),
+    ('http://download.qt.io/official_releases/qt/', 'https://download.qt.io/archive/qt/'),
+]
+
+def mirror_urls(src, extra=()):
+    '''All the urls a source can be fetched from: src itself, the ones given
+       in extra, and the ones from MIRRORS.'''
+    urls = [src] + [u for u in extra if u]
+    for group in MIRRORS:
+        for prefix in group:
+            if src.startswith(prefix):
+                rest = src[len(prefix):]
+                urls += [other + rest for other in group if other != prefix]
+    unique = []
+    for url in urls:
+        if url not in unique:
+            unique.append(url)
+    return unique
+
+class MirrorStats(object):
+    '''How fast each download server has been, kept in a json file (in
+       DOWNLOAD_DIR) so that later runs go to the fastest one first.'''
+    PROBE_BYTES = 65536
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.hosts = {}
+        try:
+            with open(filename) as f:
+                self.hosts = json.load(f)
+        except (IOError, OSError, ValueError):
+            pass
+
+    def _save(self):
+        # Called with the lock held
+        try:
+            fd, tmp = tempfile.mkstemp(dir=P.dirname(self.filename), prefix='.tmp-')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.hosts, f, indent=1, sort_keys=True)
+            os.rename(tmp, self.filename)
+        except (IOError, OSError):
+            pass
+
+    def record(self, url, nbytes, seconds):
+        '''A download from url of nbytes took that long'''
+        if nbytes <= 0 or seconds <= 0:
+            return
+        host = urlparse(url).netloc
+        with self.lock:
+            h = self.hosts.setdefault(host, {})
+            rate = nbytes / seconds
+            if 'rate' in h: # Keep some memory of the earlier downloads
+                rate = 0.7 * rate + 0.3 * h['rate']
+            h.update(rate=rate, failures=0, updated=time.time())
+            self._save()
+
+    def failure(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            h = self.hosts.setdefault(host, {})
+            h['failures'] = h.get('failures', 0) + 1
+            h['updated'] = time.time()
+            self._save()
+
+    def score(self, url):
+        '''Expected bytes per second from url, or None if we don't know'''
+        with self.lock:
+            h = self.hosts.get(urlparse(url).netloc)
+        if h is None or 'rate' not in h:
+            return None
+        return h['rate'] * 0.5 ** h.get('failures', 0)
+
+    @classmethod
+    def probe(cls, url, timeout=10):
+        '''Fetch the first bytes of url. Returns how many were read and how
+           long that took, no bytes if it failed.'''
+        start = time.time()
+        try:
+            import ssl
+            context = ssl._create_unverified_context()
+            req = Request(url, headers={'Range': 'bytes=0-%d' % (cls.PROBE_BYTES - 1)})
+            r = urlopen(req, timeout=timeout, context=context)
+            nbytes = len(r.read(cls.PROBE_BYTES))
+            r.close()
+        except Exception:
+            return 0, 0.0
+        return nbytes, max(time.time() - start, 1e-6)
+
+    def rank(self, urls):
+        '''Sort urls fastest first. Servers we know nothing about yet are
+           probed, all at once, with a small request.'''
+        if len(urls) < 2:
+            return list(urls)
+        scores = dict((url, self.score(url)) for url in urls)
+        unknown = [url for url in urls if scores[url] is None]
+        def probe(url):
+            nbytes, seconds = self.probe(url)
+            if nbytes == 0:
+                scores[url] = 0.0
+                self.failure(url)
+            else:
+                scores[url] = nbytes / seconds
+                self.record(url, nbytes, seconds)
+        threads = [threading.Thread(target=probe, args=(url,)) for url in unknown]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        # Stable, so on a tie the url the package gave comes first
+        return sorted(urls, key=lambda url: -scores[url])
+
+_mirror_stats = {}
+_mirror_stats_lock = threading.Lock()
+
+def mirror_stats(download_dir):
+    '''The MirrorStats shared by all the packages using download_dir'''
+    with _mirror_stats_lock:
+        if download_dir not in _mirror_stats:
+            _mirror_stats[download_dir] = MirrorStats(P.join(download_dir, 'mirrors.json'))
+        return _mirror_stats[download_dir]
+
+def get_mirrored(urls, output, chksum, stats):
+    '''Download output from the fastest of urls that has it with the right
+       checksum, going on to the next ones when one fails. Returns the
+       checksum of what was downloaded last, which is not chksum if none
+       of them had it.'''
+    digest = None
+    for url in stats.rank(urls):
+        part = output + '.part'
+        have = P.getsize(part) if P.exists(part) else 0
+        start = time.time()
+        try:
+            digest = get(url, output)
+            if digest != chksum and have > 0:
+                # Perhaps the partial download we resumed was of another file
+                os.remove(output)
+                digest = get(url, output, resume=False)
+                have = 0
+        except HelperError as e:
+            warn('Could not fetch %s: %s' % (url, e))
+            stats.failure(url)
+            continue
+        if digest == chksum:
+            stats.record(url, P.getsize(output) - have, time.time() - start)
+            return digest
+        warn('Wrong checksum for %s: %s' % (url, digest))
+        stats.failure(url)
+        os.remove(output)
+    if digest is None:
+        raise HelperError('urlopen', {}, 'Could not fetch any of: %s' % ' '.join(urls))
+    return digest
+
+class Trash(object):
+    '''Deletes directories in a background thread. A directory is first
+       renamed into a .trash directory next to it, which is instant, so
+       the caller can go on right away. What is left in a .trash directory
+       by an interrupted run is deleted the next time it is used.'''
+
+    # Below this much free disk space, wait for the deletions to finish
+    MIN_FREE_SPACE = 5 << 30
+
+    def __init__(self):
+        self.cond    = threading.Condition()
+        self.pending = []
+        self.seen    = set() # .trash directories already scanned for leftovers
+        self.busy    = False
+        self.count   = 0
+        self.thread  = None
+
+    def remove(self, path):
+        '''Delete the directory path, in the background if possible'''
+        path = P.abspath(path)
+        trash_dir = P.join(P.dirname(path), '.trash')
+        with self.cond:
+            self.count += 1
+            target = P.join(trash_dir, '%s.%d.%d' % (P.basename(path), os.getpid(), self.count))
+        try:
+            mkdir_f(trash_dir)
+            os.rename(path, target)
+        except OSError:
+            # Perhaps another filesystem, do it the slow way
+            rmtree(path, True)
+            return
+
+        with self.cond:
+            if trash_dir not in self.seen:
+                self.seen.add(trash_dir)
+                for leftover in os.listdir(trash_dir):
+                    leftover = P.join(trash_dir, leftover)
+                    if leftover != target and leftover not in self.pending:
+                        self.pending.append(leftover)
+            self.pending.append(target)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._worker, name='trash')
+                self.thread.daemon = True
+                self.thread.start()
+                atexit.register(self.drain)
+            self.cond.notify_all()
+
+        # Don't let the old trees eat the space the new one needs
+        free = self._free_space(trash_dir)
+        if free is not None and free < self.MIN_FREE_SPACE:
+            info('Low on disk space, waiting for old build directories to be deleted')
+            self.drain()
+
+    @staticmethod
+    def _free_space(path):
+        '''Bytes free on the filesystem of path, None if it can't be told'''
+        try:
+            st = os.statvfs(path)
+            return st.f_bavail * st.f_frsize
+        except (OSError, AttributeError):
+            return None
+
+    def _worker(self):
+        def make_writable(func, path, exc_info):
+            # Read-only directories in source trees are common
+            try:
+                os.chmod(P.dirname(path), 0o700)
+                os.chmod(path, 0o700)
+                func(path)
+            except OSError:
+                pass
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                path = self.pending.pop(0)
+                self.busy = True
+            try:
+                if P.isdir(path) and not P.islink(path):
+                    rmtree(path, False, make_writable)
+                else:
+                    os.remove(path)
+            except OSError:
+                pass
+            with self.cond:
+                self.busy = False
+                self.cond.notify_all()
+
+    def drain(self):
+        '''Wait until everything given to remove() is deleted'''
+        with self.cond:
+            if self.pending or self.busy:
+                info('Waiting for %d old build directories to be deleted' %
+                     (len(self.pending) + int(self.busy)))
+            while self.pending or self.busy:
+                self.cond.wait(1.0)
+
+trash = Trash()
+
+class AutoconfCache(object):
+    '''A config.cache shared by the autoconf configure scripts of all the
+       packages built with the same compilers and flags. Only the results
+       which depend on nothing but the toolchain are shared: the compiler
+       checks, libtool's, the size of the standard types and the presence
+       of the standard headers. Whatever depends on the package or on what
+       is installed already (libraries, functions, programs, other headers)
+       is left for each configure script to find out.'''
+
+    SHARED = re.compile(r'^(ac_cv_(build|host|target|objext|exeext|c_compiler_gnu|cxx_compiler_gnu'
+                        r'|prog_cc_\w+|prog_cxx_\w+|prog_CPP|prog_CXXCPP|prog_ac_ct_CC|prog_ac_ct_CXX'
+                        r'|prog_AWK|prog_make_make_set|path_(GREP|EGREP|FGREP|SED|install|mkdir)'
+                        r'|c_(bigendian|const|inline|restrict|volatile|char_unsigned)|sys_\w+|header_stdc'
+                        r'|(sizeof|alignof|type)_(unsigned_)?(char|short|int|long|long_long|long_int'
+                        r'|float|double|long_double|void_p|size_t|ssize_t|off_t|ptrdiff_t|wchar_t'
+                        r'|intmax_t|uintmax_t|intptr_t|uintptr_t|u?int(8|16|32|64)_t|pid_t|mode_t'
+                        r'|uid_t|gid_t|time_t|_Bool)'
+                        r'|header_(stdio|stdlib|string|strings|memory|inttypes|stdint|unistd|dlfcn'
+                        r'|fcntl|limits|locale|math|float|stddef|stdarg|errno|signal|time|wchar'
+                        r'|wctype|ctype|dirent|malloc|assert|setjmp|pthread|pwd|grp|poll|termios'
+                        r'|netdb|sys_types|sys_stat|sys_time|sys_param|sys_mman|sys_socket'
+                        r'|sys_select|sys_wait|sys_resource|sys_ioctl|sys_un|netinet_in|arpa_inet)_h'
+                        r')|lt_cv_\w+)$')
+
+    _lock = threading.Lock()
+    _compilers = {}
+
+    def __init__(self, root):
+        self.root = root
+
+    @classmethod
+    def fingerprint(cls, pkg):
+        '''A hash of the compilers and flags of a package, without the
+           parts which only depend on where the build root is'''
+        env = pkg.env
+        h = sha1()
+        for var in ('CC', 'CXX'):
+            if env.get(var) not in cls._compilers:
+                out = run(env[var], '--version', env=env, raise_on_failure=False)
+                cls._compilers[env.get(var)] = out.split('\n')[0] if isinstance(out, string_types) else ''
+            h.update(('%s=%s %s\0' % (var, env.get(var), cls._compilers[env.get(var)])).encode('utf-8'))
+        for var in ('CFLAGS', 'CXXFLAGS', 'CPPFLAGS', 'LDFLAGS'):
+            flags = env.get(var, '').split()
+            if pkg.workdir is not None:
+                flags = [f for f in flags if f != '-I' + pkg.workdir + '/include']
+            value = ' '.join(flags)
+            for d in ('INSTALL_DIR', 'BUILD_DIR', 'ISIS3RDPARTY'):
+                if env.get(d):
+                    value = value.replace(env[d], '@%s@' % d)
+            h.update(('%s=%s\0' % (var, value)).encode('utf-8'))
+        return h.hexdigest()
+
+    @classmethod
+    def _read(cls, filename):
+        '''The shareable lines of a config.cache, by variable name'''
+        entries = OrderedDict()
+        try:
+            with open(filename) as f:
+                for line in f:
+                    line = line.rstrip('\n')
+                    m = re.match(r'^(?:test "\$\{)?(\w+)', line)
+                    # Skip the lines of values going over more than one line
+                    if m and cls.SHARED.match(m.group(1)) and line.count("'") % 2 == 0:
+                        entries[m.group(1)] = line
+        except IOError:
+            pass
+        return entries
+
+    def path(self, fingerprint):
+        return P.join(self.root, fingerprint + '.cache')
+
+    def seed(self, fingerprint, cache_file):
+        '''Start cache_file with the results shared by earlier packages'''
+        with self._lock:
+            entries = self._read(self.path(fingerprint))
+        with open(cache_file, 'w') as f:
+            f.write('# Seeded from %s\n' % self.path(fingerprint))
+            for line in entries.values():
+                f.write(line + '\n')
+
+    def merge(self, fingerprint, cache_file):
+        '''Add the shareable results of a configure run to the shared cache'''
+        new = self._read(cache_file)
+        if not new:
+            return
+        mkdir_f(self.root)
+        shared = self.path(fingerprint)
+        with self._lock:
+            entries = self._read(shared)
+            if all(entries.get(k) == v for k, v in new.items()):
+                return
+            entries.update(new)
+            fd, tmp = tempfile.mkstemp(dir=self.root, prefix='.tmp-')
+            with os.fdopen(fd, 'w') as f:
+                for line in entries.values():
+                    f.write(line + '\n')
+            os.rename(tmp, shared)
+
+STAGES = ('fetch', 'unpack', 'configure', 'compile', 'install')
+# Bump this to throw away the source trees made by an older unpack
+SOURCE_CACHE_VERSION = '2'
+# Environment variables which change from one run to the next without
+# changing what gets built
+STAMP_IGNORE_ENV = ('STATS_RUN', 'GIT_HEADS_TTL', 'LOG_DIR')
+
 class Package(object):
     '''Class to represent a single package that needs to be built.
        This class assumes the code for the package is posted online as a compressed file
@@ -248,6 +1169,11 @@ class Package(object):
     chksum  = None
     patches = []
     patch_level = None
+    deps    = [] # Names of the packages that must be built before this one
+    mirrors = [] # Other urls for src (a tuple of urls for each mirror, if src is a tuple)
+    unpack_exclude = [] # Patterns of paths in the tarball not to unpack, like 'doc/*'
+    cacheable = True # Whether what the package installs can be reused from the cache
+    autoconf_cache = True # Whether configure may use the shared AutoconfCache
 
     def __init__(self, env):
         '''Construct with the environment info'''
@@ -261,7 +1187,7 @@ class Package(object):
         #info(self.pkgdir)
         self.tarball = None
         self.workdir = None
-        self.env = copy.deepcopy(env) # local copy of the environment, not affecting other packages
+        self.env = env.copy_set_default() # local copy of the environment, not affecting other packages
         self.arch = get_platform(self)
 
         self.env['CPPFLAGS'] = self.env.get('CPPFLAGS', '') + ' -I%(INSTALL_DIR)s/include' % self.env
@@ -281,7 +1207,56 @@ class Package(object):
         self.env['CFLAGS'  ] = unique_compiler_flags(self.env['CFLAGS'  ])
         self.env['LDFLAGS' ] = unique_compiler_flags(self.env['LDFLAGS' ])
 
+        if _compiler_cache is not None:
+            _compiler_cache.prepare(self)
+
+    @classmethod
+    def dependencies(cls):
+        '''Names of all the packages this one depends on. The deps declared
+           on a class add to the ones declared on its base classes.'''
+        deps = []
+        for klass in reversed(cls.__mro__):
+            for dep in klass.__dict__.get('deps', []):
+                if dep not in deps:
+                    deps.append(dep)
+        return deps
+
+    def _mirrors(self, src):
+        '''The urls listed in self.mirrors for one of the sources'''
+        mirrors = self.mirrors
+        if isinstance(mirrors, str):
+            mirrors = [mirrors]
+        srcs = self.src if isinstance(self.src, (list, tuple)) else (self.src,)
+        urls = []
+        for m in mirrors:
+            if isinstance(m, (list, tuple)):
+                # One url for each of the sources
+                m = m[list(srcs).index(src)] if len(m) == len(srcs) else None
+            elif len(srcs) > 1:
+                m = None
+            if m:
+                urls.append(m)
+        return urls
+
+    @classmethod
+    def source_host(cls):
+        '''The server the sources of the package come from'''
+        src = cls.src
+        if isinstance(src, (list, tuple)):
+            src = src[0] if src else None
+        if not src:
+            return None
+        host = urlparse(src).hostname
+        if host:
+            return host
+        # scp-like git urls, user@host:path
+        m = re.match(r'^(?:[^@/:]+@)?([^/:]+):', src)
+        if m:
+            return m.group(1).lower()
+        return src
+
     @stage
+    @retried
     def fetch(self, skip=False):
         '''After fetch, the source code should be available.'''
 
@@ -294,30 +1269,25 @@ class Package(object):
 
         assert len(self.src) == len(self.chksum), 'len(src) and len(chksum) should be the same'
 
-        # Do two attempts, perhaps the locally cached version of the tarball
-        # is not up-to-date, in that case remove it and try again.
-        is_good = False
-        chksum = ""
-        curr_chksum = ""
-        for i in range(0, 2):
-
-            for src, chksum in zip(self.src, self.chksum):
-                # Get the tarball path and if we don't have it, download it from the url (src)
-                self.tarball = P.join(self.env['DOWNLOAD_DIR'], P.basename(urlparse(src).path))
-                if not P.isfile(self.tarball):
-                    if skip: raise PackageError(self, 'Fetch is skipped and no src available')
-                    get(src, self.tarball)
-
-                # See if we got the expected checksum
-                curr_chksum = hash_file(self.tarball)
-                if curr_chksum != chksum:
-                    os.remove(self.tarball) # Remove the bad tarball so we fetch it on the second pass
-                else:
-                    is_good = True
+        for src, chksum in zip(self.src, self.chksum):
+            # Get the tarball path and if we don't have it, download it from the url (src)
+            self.tarball = P.join(self.env['DOWNLOAD_DIR'], P.basename(urlparse(src).path))
+            if P.isfile(self.tarball):
+                if hash_file(self.tarball) == chksum:
+                    continue
+                # The locally cached version of the tarball is not up-to-date
+                os.remove(self.tarball)
+            if skip: raise PackageError(self, 'Fetch is skipped and no src available')
 
-        if not is_good:
-            raise PackageError(self, 'Checksum on file[%s] failed. Expected %s but got %s. Removed!'
-                               % (self.tarball, chksum, curr_chksum) )
+            # The checksum is computed while downloading, from whichever
+            # of the mirrors has been the fastest.
+            urls = mirror_urls(src, self._mirrors(src))
+            curr_chksum = get_mirrored(urls, self.tarball, chksum,
+                                       mirror_stats(self.env['DOWNLOAD_DIR']))
+            if curr_chksum != chksum:
+                raise PackageError(self, 'Checksum on file[%s] failed. Expected %s but got %s. Removed!'
+                                   % (self.tarball, chksum, curr_chksum) )
+            remember_hash(self.tarball, curr_chksum)
 
     @stage
     def unpack(self):
@@ -327,32 +1297,27 @@ class Package(object):
         output_dir = P.join(self.env['BUILD_DIR'], self.pkgname)
 
         self.remove_build(output_dir) # Throw out the old content
-        ext = P.splitext(self.tarball)[-1]
-        
-        # Call the appropriate tool to unpack the code into the build directory
-        if ext == '.zip':
-            self.helper('unzip', '-d', output_dir, self.tarball)
-        else:
-            flags = 'xf'
-            if ext == '.Z' or ext.endswith('gz'):
-                flags = 'z' + flags
-            elif ext.endswith('xz'):
-                flags = 'J' + flags
-            elif ext.endswith('bz2'):
-                flags = 'j' + flags
-            self.helper('tar', flags, self.tarball, '-C',  output_dir)
-
-        # If the user didn't provide a work directory define it as the
-        # single directory output from tarball.
-        if self.workdir is None:
-            self.workdir = glob(P.join(output_dir, "*"))
-            if len(self.workdir) != 1:
-                raise PackageError(self, 'Badly-formed tarball[%s]: there should be 1 file in the output dir [%s], but there are %i' %
-                                   (self.tarball, output_dir, len(self.workdir)))
 
-            self.workdir = self.workdir[0]
-
-        self._apply_patches()
+        # The patched sources only depend on the tarball and the patches,
+        # so they are taken from the source cache when they are there.
+        tree = self._source_tree()
+        if tree is not None and P.isdir(tree):
+            info('Copying the patched sources of %s from %s' % (self.tarball, tree))
+            with open(P.join(tree, 'tree.json')) as f:
+                top = json.load(f)['top']
+            os.rmdir(output_dir)
+            clone_tree(P.join(tree, 'src'), output_dir, link=True)
+            self._set_workdir(output_dir, top)
+        else:
+            info('Unpacking %s' % self.tarball)
+            try:
+                top = unpack_archive(self.tarball, output_dir, self.unpack_exclude)
+            except (tarfile.TarError, zipfile.BadZipfile, IOError, OSError) as e:
+                raise PackageError(self, 'Failed to unpack %s: %s' % (self.tarball, e))
+            self._set_workdir(output_dir, top)
+            self._apply_patches()
+            if tree is not None:
+                self._save_source_tree(tree, output_dir, top)
 
         # Prepend the work dir to the include/link dirs, to ensure the newest
         # version of any software is used. This is a bugfix.
@@ -360,6 +1325,62 @@ class Package(object):
         self.env['CXXFLAGS'] = '-I' + self.workdir + '/include ' + self.env['CXXFLAGS']
         self.env['CFLAGS'  ] = '-I' + self.workdir + '/include ' + self.env['CFLAGS']
         #self.env['LDFLAGS' ] = '-L' + self.workdir + '/lib ' + self.workdir + '/lib64 '  + self.env['LDFLAGS']
+
+    def _set_workdir(self, output_dir, top):
+        # If the user didn't provide a work directory define it as the
+        # single directory output from tarball.
+        if self.workdir is None:
+            if len(top) != 1 or not P.isdir(P.join(output_dir, top[0])):
+                raise PackageError(self, 'Badly-formed tarball[%s]: there should be 1 file in the output dir [%s], but there are %i' %
+                                   (self.tarball, output_dir, len(top)))
+
+            self.workdir = P.join(output_dir, top[0])
+
+    def _source_tree(self):
+        '''Where the patched sources of the package are kept in the source
+           cache, keyed by the hash of the tarball and of the patches. None
+           if there is no source cache.'''
+        cache_dir = self.env.get('SOURCE_CACHE_DIR')
+        if not cache_dir or not self.tarball:
+            return None
+        h = sha1()
+        def add(*items):
+            for item in items:
+                if not isinstance(item, bytes):
+                    item = str(item).encode('utf-8')
+                h.update(item)
+                h.update(b'\0')
+        add(SOURCE_CACHE_VERSION, hash_file(self.tarball), self.patch_level, *self.unpack_exclude)
+        if self.workdir is not None:
+            # The patches are applied there
+            add(P.relpath(self.workdir, P.join(self.env['BUILD_DIR'], self.pkgname)))
+        for patch in self._patch_files():
+            if not P.isfile(patch):
+                return None # _apply_patches will complain
+            with open(patch, 'rb') as f:
+                add(P.basename(patch), f.read())
+        key = h.hexdigest()
+        return P.join(cache_dir, self.pkgname, key)
+
+    def _save_source_tree(self, tree, output_dir, top):
+        '''Put a copy of the freshly patched sources in the source cache'''
+        parent = P.dirname(tree)
+        mkdir_f(parent)
+        tmp = tempfile.mkdtemp(dir=parent, prefix='.tmp-')
+        try:
+            clone_tree(output_dir, P.join(tmp, 'src'), link=True)
+            with open(P.join(tmp, 'tree.json'), 'w') as f:
+                json.dump(dict(tarball=P.basename(self.tarball), top=top), f)
+            os.rename(tmp, tree)
+        except OSError as e:
+            # Out of space, or another build saved it first
+            warn('Could not save the sources of %s to %s: %s' % (self.pkgname, tree, e))
+            rmtree(tmp, ignore_errors=True)
+        else:
+            # Only the latest sources of each package are worth keeping
+            for old in glob(P.join(parent, '*')):
+                if old != tree and not P.basename(old).startswith('.'):
+                    trash.remove(old)
     @stage
     def configure(self, other=(), with_=(), without=(), enable=(), disable=(), configure='./configure'):
         '''After configure, the source code should be ready to build.'''
@@ -382,9 +1403,29 @@ class Package(object):
         if len([True for a in args if a[:9] == '--prefix=']) == 0:
             args.append('--prefix=%(INSTALL_DIR)s' % self.env)
 
+        # Start from the results of the compiler checks of other packages,
+        # and share the ones of this package once it is configured.
+        shared = None
+        if self.autoconf_cache and self.env.get('AUTOCONF_CACHE_DIR') and \
+               not any(a in ('-C', '--config-cache') or a.startswith('--cache-file') for a in args):
+            try:
+                with open(P.join(self.workdir, 'configure')) as f:
+                    generated = 'Generated by GNU Autoconf' in f.read(4096)
+            except IOError:
+                generated = False
+            if generated:
+                shared = AutoconfCache(self.env['AUTOCONF_CACHE_DIR'])
+                fingerprint = shared.fingerprint(self)
+                cache_file = P.join(self.workdir, 'config.cache')
+                shared.seed(fingerprint, cache_file)
+                args.append('--cache-file=' + cache_file)
+
         # Call the package's configure script with the parsed arguments
         self.helper('./configure', *args)
 
+        if shared is not None:
+            shared.merge(fingerprint, cache_file)
+
     @stage
     def compile(self, cwd=None):
         '''After compile, the compiled code should exist.'''
@@ -406,23 +1447,208 @@ class Package(object):
         self.helper(*cmd, env=e, cwd=cwd)
 
     @staticmethod
-    def build(pkg, skip_fetch=False):
-        '''Shortcut to call all steps for a package with no arguments'''
+    def build(pkg, skip_fetch=False, cache=None, key=None, resume=False):
+        '''Shortcut to call all steps for a package with no arguments.
+           If an ArtifactCache and the package key are given, the files the
+           package installs are taken from the cache when they are there,
+           and saved to it after they are built otherwise. With resume, the
+           stages already done for the same inputs by an earlier build are
+           not done again.'''
         # If it's a type, we instantiate it. Otherwise, we just use whatever it is.
         assert isinstance(pkg, Package)
-        pkg.fetch(skip=skip_fetch)
-        pkg.unpack()
-        pkg.configure()
-        pkg.compile()
-        pkg.install()
+        if cache is None or key is None:
+            cache = None
+        elif cache.has(key):
+            with installing(pkg) as recording:
+                _current_stage.recording = recording
+                try:
+                    restored = pkg.restore(cache, key)
+                finally:
+                    _current_stage.recording = None
+                if restored:
+                    recording.finish()
+                    return
+
+        # Each stage leaves a stamp behind. When resuming, the stages with
+        # a stamp still valid for the inputs of this build are skipped.
+        stamps = pkg._stamp_keys()
+        first = 0
+        if resume:
+            state = None
+            for i, name in enumerate(STAGES):
+                found = pkg._read_stamp(name, stamps[name])
+                if found is None:
+                    break
+                state = found
+                first = i + 1
+            if state is not None:
+                pkg._restore_state(state)
+                if first < len(STAGES):
+                    info('Resuming %s at %s' % (pkg.pkgname, STAGES[first]))
+                else:
+                    info('All stages of %s are done already' % pkg.pkgname)
+        pkg._remove_stamps(STAGES[first:])
+
+        recording = None
+        for name in STAGES[first:]:
+            if recording is None and name in ('configure', 'compile', 'install'):
+                # Some packages install while they compile, so what the
+                # package installs is what changed since it configured
+                recording = installing(pkg, pkg._install_snapshot(fresh=(name == 'configure')))
+            if name == 'fetch':
+                pkg.fetch(skip=skip_fetch)
+            elif name == 'install':
+                # Record what the package installed while no other package
+                # is installing, and save that to the cache once they can
+                with recording:
+                    _current_stage.recording = recording
+                    try:
+                        pkg.install()
+                    finally:
+                        _current_stage.recording = None
+                    manifest = recording.finish()
+                if cache is not None:
+                    try:
+                        cache.store(pkg, key, manifest)
+                    except Exception as e:
+                        warn('Could not save %s to the cache: %s' % (pkg.pkgname, e))
+            else:
+                getattr(pkg, name)()
+            pkg._write_stamp(name, stamps[name])
+
+    def _stamp_dir(self):
+        return P.join(self.env['BUILD_DIR'], '.stamps', self.pkgname)
+
+    def _install_snapshot(self, fresh):
+        '''A snapshot of INSTALL_DIR to tell what the package installs.
+           Unless fresh, the one taken before an earlier build was
+           interrupted, so a resumed build still sees the files installed
+           by the stages it does not do again.'''
+        filename = P.join(self._stamp_dir(), 'install-snapshot.json')
+        if not fresh:
+            try:
+                with open(filename) as f:
+                    return dict((name, tuple(st)) for name, st in json.load(f).items())
+            except (IOError, OSError, ValueError):
+                pass
+        state = install_snapshot(self.env['INSTALL_DIR'])
+        mkdir_f(self._stamp_dir())
+        fd, tmp = tempfile.mkstemp(dir=self._stamp_dir(), prefix='.tmp-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp, filename)
+        return state
+
+    def _stamp_keys(self):
+        '''The stamp each stage should have for this build: a hash of the
+           inputs of the package (sources, patches, environment and build
+           recipe) chained through the stamps of the stages before it.'''
+        h = sha1()
+        def add(*items):
+            for item in items:
+                if not isinstance(item, bytes):
+                    item = str(item).encode('utf-8')
+                h.update(item)
+                h.update(b'\0')
+        add(self.pkgname)
+        chksum = self.chksum
+        add(*(chksum if isinstance(chksum, (list, tuple)) else (chksum,)))
+        downloads = P.abspath(self.env['DOWNLOAD_DIR'])
+        for patch in self._patch_files():
+            # Those fetched with the sources may not be downloaded yet,
+            # the checksums above stand for them
+            if not P.isfile(patch) or P.dirname(P.abspath(patch)) == downloads:
+                continue
+            with open(patch, 'rb') as f:
+                add(P.basename(patch), f.read())
+        for var in sorted(self.env):
+            if var not in STAMP_IGNORE_ENV:
+                add(var, self.env[var])
+        for klass in type(self).__mro__:
+            if klass is not object:
+                try:
+                    add(inspect.getsource(klass))
+                except (IOError, TypeError):
+                    pass
+        keys = {}
+        prev = h.hexdigest()
+        for name in STAGES:
+            prev = sha1(('%s\0%s' % (prev, name)).encode('utf-8')).hexdigest()
+            keys[name] = prev
+        return keys
+
+    def _save_state(self):
+        '''The attributes of the package the later stages may rely on, like
+           the tarball, workdir and the environment, in a form fit for json'''
+        state = {}
+        for attr, value in self.__dict__.items():
+            if isinstance(value, Environment):
+                state[attr] = dict(__env__=dict(value))
+                continue
+            try:
+                json.dumps(value)
+            except (TypeError, ValueError):
+                continue # Not needed to resume, or recomputed by __init__
+            state[attr] = value
+        return state
+
+    def _restore_state(self, state):
+        for attr, value in state.items():
+            current = getattr(self, attr, None)
+            if isinstance(value, dict) and '__env__' in value and isinstance(current, Environment):
+                current.clear()
+                current.update(value['__env__'])
+            else:
+                setattr(self, attr, value)
 
-    def _apply_patches(self):
+    def _read_stamp(self, name, key):
+        '''The state saved with the stamp of a stage, or None if there is no
+           stamp or it is not valid anymore'''
+        try:
+            with open(P.join(self._stamp_dir(), name)) as f:
+                stamp = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if stamp.get('key') != key:
+            return None
+        state = stamp.get('state', {})
+        # The files the stamp vouches for must still be there
+        for attr in ('tarball', 'workdir', 'builddir'):
+            path = state.get(attr)
+            if path is not None and not P.exists(path):
+                return None
+        return state
+
+    def _write_stamp(self, name, key):
+        dirname = self._stamp_dir()
+        mkdir_f(dirname)
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(dict(key=key, stage=name, time=time.time(),
+                           state=self._save_state()), f, sort_keys=True)
+        os.rename(tmp, P.join(dirname, name))
+
+    def _remove_stamps(self, names):
+        for name in names:
+            try:
+                os.remove(P.join(self._stamp_dir(), name))
+            except OSError:
+                pass
+
+    @stage
+    def restore(self, cache, key):
+        '''Copy the files the package installs from the artifact cache
+           instead of building it. Returns False if that didn't work.'''
+        return cache.restore(self, key)
+
+    def _patch_files(self):
+        '''The list of patch files to apply to the package'''
         # self.patches could be:
         #    list of strings, interpreted as a list of patches
         #    a string, interpreted as a patch or a dir of patches
         patches = []
         if self.patches is None:
-            return
+            return patches
         elif isinstance(self.patches, str):
             # Grab all of the patch file paths out of the provided directory
             full = P.join(self.pkgdir, self.patches)
@@ -441,6 +1667,12 @@ class Package(object):
         else: # Input is already a list of patch files
             patches = self.patches
 
+        # Skip junk file paths
+        return [p for p in patches if not (p.endswith('~') or p.endswith('#'))]
+
+    def _apply_patches(self):
+        patches = self._patch_files()
+
         def _apply(patch):
             '''Helper function to apply a patch with a custom self.patch_level'''
             if self.patch_level is None:
@@ -450,16 +1682,19 @@ class Package(object):
 
         # We have a list of patches now, but we can't trust they're all there
         for p in patches:
-            if p.endswith('~') or p.endswith('#'): # Skip junk file paths
-                continue
             if not P.isfile(p):
                 raise PackageError(self, 'Unknown patch: %s' % p)
             _apply(p) # The patch file is there, apply it!
 
 
     def helper(self, *args, **kw):
-        '''Run a command line command with some extra argument handling'''
+        '''Run a command line command with some extra argument handling.
+           Unless it is given somewhere else to print to, its output goes
+           to the log of the current stage, if there is one.'''
         info(' '.join(args))
+        log = None
+        if 'stdout' not in kw:
+            log = getattr(_current_stage, 'log', None)
         kw['stdout'] = kw.get('stdout', sys.stdout)
         kw['stderr'] = kw.get('stderr', kw['stdout'])
 
@@ -467,10 +1702,22 @@ class Package(object):
             kw['cwd'] = self.workdir
         if kw.get('env', None) is None:
             kw['env'] = self.env
+        if isinstance(kw['env'], Environment):
+            kw['env'] = kw['env'].flat()
         kw['raise_on_failure'] = False
         kw['want_stderr'] = True
 
+        stats = getattr(_current_stage, 'stats', None)
+        if stats is not None:
+            kw['rusage'] = stats.add
+
+        tokens = b''
+        if _jobserver is not None:
+            args, tokens = _jobserver.prepare(list(args), kw)
+
         try:
+            if log is not None:
+                return self._run_logged(args, log, kw)
             out, err = run(*args, **kw)
             if out is None:
                 return out, err
@@ -481,6 +1728,39 @@ class Package(object):
             raise Exception('%s\n%s' % (e.message, '\t\n'.join(['\t%s=%s%s' % (name, type(value).__name__, value) for name,value in kw['env'].iteritems() if not isinstance(value, str)])))
         except (OSError, subprocess.CalledProcessError) as e:
             raise HelperError(args[0], kw['env'], e)
+        finally:
+            if tokens:
+                _jobserver.release(tokens)
+
+    @staticmethod
+    def _run_logged(args, log, kw):
+        '''Run a command from helper() with its output streamed to a StageLog'''
+        log.write('$ %s\n' % ' '.join(args))
+        on_rusage = kw.pop('rusage', None)
+        for k in ('stdout', 'stderr', 'raise_on_failure', 'want_stderr'):
+            kw.pop(k, None)
+        p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **kw)
+        try:
+            for line in iter(p.stdout.readline, b''):
+                log.write(line)
+        finally:
+            p.stdout.close()
+        if on_rusage is not None:
+            while True:
+                try:
+                    pid, status, usage = os.wait4(p.pid, 0)
+                    break
+                except OSError as e:
+                    if e.errno != errno.EINTR:
+                        raise
+            p.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+            on_rusage(usage)
+        else:
+            p.wait()
+        if p.returncode != 0:
+            raise HelperError(args[0], kw['env'], 'return code %d, the last lines of %s were:\n%s' %
+                              (p.returncode, log.path, '\n'.join(log.tail)))
+        return None, None
 
     def copytree(self, src, dest, args=(), delete=True):
         '''rsync wrapper to duplicate a directory to a new location'''
@@ -491,20 +1771,73 @@ class Package(object):
         call += [src, dest]
         self.helper(*call)
 
-    # TODO: Delete the installed files!
     def remove_build(self, output_dir):
-        '''Make output_dir into an empty directory, deleting everything that is inside.'''
+        '''Make output_dir into an empty directory, deleting everything that is inside.
+           The old content is moved out of the way at once and deleted in
+           the background.'''
         if P.isdir(output_dir):
             info("Removing old build directory: " + output_dir)
-            rmtree(output_dir, False)
+            trash.remove(output_dir)
         os.makedirs(output_dir)
 
+_remote_heads = {}
+_remote_heads_lock  = threading.Lock() # Guards the two dicts and the cache file
+_remote_heads_locks = {} # One per repository, held while looking it up
+
+def _read_heads(cache_file):
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def remote_head(url, env, cache_file=None, ttl=0, branch='master'):
+    '''The commit at the head of a branch of a git repository. It is looked
+       up with git ls-remote once per run. If ttl is more than 0, it is also
+       kept in cache_file and looked up again only after ttl seconds.
+       Different repositories are looked up at the same time, a slow
+       server only holds up the packages coming from it.'''
+    key = '%s#%s' % (url, branch)
+    with _remote_heads_lock:
+        lock = _remote_heads_locks.setdefault(key, threading.Lock())
+    with lock:
+        with _remote_heads_lock:
+            if key in _remote_heads:
+                return _remote_heads[key]
+            if cache_file is not None and ttl > 0:
+                heads = _read_heads(cache_file)
+                if key in heads and time.time() - heads[key][1] < ttl:
+                    _remote_heads[key] = heads[key][0]
+                    return _remote_heads[key]
+
+        info('git ls-remote --heads %s' % url)
+        def ls_remote():
+            out = run('git', 'ls-remote', '--heads', url, env=env, raise_on_failure=False)
+            if not isinstance(out, string_types):
+                raise HelperError('git ls-remote', {}, out[1])
+            return out
+        out = _retry_policy.call(ls_remote, 'git ls-remote %s' % url)
+        commit = None
+        for line in out.split('\n'):
+            tokens = line.split()
+            if len(tokens) > 1 and tokens[1] == 'refs/heads/' + branch:
+                commit = tokens[0]
+
+        with _remote_heads_lock:
+            _remote_heads[key] = commit
+            if cache_file is not None and ttl > 0 and commit is not None:
+                # Read it again, others may have been added meanwhile
+                heads = _read_heads(cache_file)
+                heads[key] = [commit, time.time()]
+                mkdir_f(P.dirname(cache_file))
+                write_if_changed(cache_file, json.dumps(heads, indent=1, sort_keys=True))
+        return commit
+
 class GITPackage(Package):
     ''' A git package does not have a checksum. Here we interpret
         this variable as the commit id. This is a bit confusing.
         The goal here is to not re-build a git package if
         we already built it with given commit id.'''
-    chksum = None
     fast = False
     def __init__(self, env):
         super(GITPackage, self).__init__(env)
@@ -518,15 +1851,21 @@ class GITPackage(Package):
         if 'FAST' in env and int(env['FAST']) != 0:
             self.fast = True
 
-        if self.chksum is None:
-            # If the user did not specify which commit to fetch,
-            # we'll fetch the latest. Store its commit hash.
-            for line in self.helper('git', 'ls-remote', '--heads', self.src,
-                                    env = self.local_env,
-                                    stdout=subprocess.PIPE)[0].split('\n'):
-                tokens = line.split()
-                if len(tokens) > 1 and tokens[1] == 'refs/heads/master':
-                    self.chksum = tokens[0]
+        self._chksum = None
+
+    @property
+    def chksum(self):
+        '''The commit to build. Packages which don't set one get the
+           latest commit on master, looked up the first time it is needed.'''
+        if self._chksum is None:
+            self._chksum = remote_head(self.src, self.local_env,
+                                       P.join(self.env['DOWNLOAD_DIR'], 'git', 'heads.json'),
+                                       int(self.env.get('GIT_HEADS_TTL', 0)))
+        return self._chksum
+
+    @chksum.setter
+    def chksum(self, value):
+        self._chksum = value
 
     def _git(self, *args):
         '''Call a git command from the local folder we are using for this package.'''
@@ -535,6 +1874,7 @@ class GITPackage(Package):
         self.helper(*cmd, env = self.local_env)
 
     @stage
+    @retried
     def fetch(self, skip=False):
         '''Override the fetch function to call git fetch or git clone'''
         if P.exists(self.localcopy):
@@ -562,15 +1902,50 @@ class GITPackage(Package):
             self.remove_build(output_dir)
             
         mkdir_f(self.workdir)
-            
-        self.helper('git', 'clone', '--recurse-submodules', self.localcopy, self.workdir,
-                    env = self.local_env)
-        
+
+        # How to get a checkout out of the local mirror:
+        #   shared:   a clone borrowing the objects of the mirror (the default)
+        #   worktree: a worktree of the mirror itself
+        #   partial:  a clone with only the files of the commit checked out
+        #   full:     a clone with the whole history
+        # Only "full" copies the history, the others take the time and
+        # space of the checkout. The first two rely on the mirror staying
+        # where it is.
+        mode = self.env.get('GIT_CLONE', 'shared')
+        commit = self.chksum if self.chksum is not None else 'HEAD'
+        if mode == 'full':
+            self.helper('git', 'clone', '--recurse-submodules', self.localcopy, self.workdir,
+                        env = self.local_env)
+        elif mode == 'worktree':
+            self._git('worktree', 'prune') # Forget the ones removed with old builds
+            self._git('worktree', 'add', '--detach', '--force', self.workdir, commit)
+        elif mode == 'partial':
+            # Set in the mirror, as upload-pack reads it there, both for
+            # the clone and for fetching the files checkout needs
+            self._git('config', 'uploadpack.allowFilter', 'true')
+            self.helper('git', 'clone', '--no-checkout', '--filter=blob:none',
+                        'file://' + P.abspath(self.localcopy), self.workdir,
+                        env = self.local_env)
+        elif mode == 'shared':
+            self.helper('git', 'clone', '--shared', '--no-checkout', self.localcopy, self.workdir,
+                        env = self.local_env)
+        else:
+            raise PackageError(self, 'Unknown GIT_CLONE mode: %s' % mode)
+
         # Checkout a specific commit
-        if self.chksum is not None:
-            cmd = ('git', 'checkout', self.chksum)
+        if mode != 'worktree' and (self.chksum is not None or mode != 'full'):
+            cmd = ('git', 'checkout', commit)
             self.helper(*cmd, cwd=self.workdir, env = self.local_env)
-            
+
+        if mode != 'full' and P.exists(P.join(self.workdir, '.gitmodules')):
+            # Only the commits the submodules are at, if their server lets us
+            try:
+                self.helper('git', 'submodule', 'update', '--init', '--recursive', '--depth', '1',
+                            cwd=self.workdir, env = self.local_env)
+            except HelperError:
+                self.helper('git', 'submodule', 'update', '--init', '--recursive',
+                            cwd=self.workdir, env = self.local_env)
+
         self._apply_patches()
 
 class SVNPackage(Package):
@@ -588,6 +1963,7 @@ class SVNPackage(Package):
                 return tokens[1]
 
     @stage
+    @retried
     def fetch(self, skip=False):
         '''Call SVN update or checkout to download the code'''
         try:
@@ -603,7 +1979,7 @@ class SVNPackage(Package):
                 self.helper('svn', 'checkout', self.src, self.localcopy)
         except HelperError as e:
             warn('svn failed (removing %s): %s' % (self.localcopy, e))
-            rmtree(self.localcopy)
+            trash.remove(self.localcopy)
             self.helper('svn', 'checkout', self.src, self.localcopy)
 
     @stage
@@ -618,8 +1994,24 @@ class SVNPackage(Package):
 
         self._apply_patches()
 
+_cmake_versions = {}
+
+def cmake_version(env):
+    '''The version of the cmake in the PATH of env, as a tuple'''
+    try:
+        cmake = find_file('cmake', env['PATH'])
+    except Exception:
+        return ()
+    if cmake not in _cmake_versions:
+        out = run(cmake, '--version', raise_on_failure=False)
+        m = re.search(r'(\d+)\.(\d+)', out) if isinstance(out, string_types) else None
+        _cmake_versions[cmake] = tuple(int(v) for v in m.groups()) if m else ()
+    return _cmake_versions[cmake]
+
 class CMakePackage(Package):
-    '''Package variant that must be built using CMake'''
+    '''Package variant that must be built using CMake. It is built with
+       Ninja if it is installed, with make otherwise. Set generator to
+       pick one.'''
     # Don't allow these to be specified by the user, we need control over these.
     BLACKLIST_VARS = (
             'CMAKE_BUILD_TYPE',
@@ -628,10 +2020,28 @@ class CMakePackage(Package):
             'CMAKE_OSX_DEPLOYMENT_TARGET',
             'CMAKE_OSX_SYSROOT',
     )
+    deps = ['cmake']
+    generator = None # The CMake generator, None for Ninja if it is there
 
     def __init__(self, env):
         super(CMakePackage, self).__init__(env)
 
+    def _generator(self, args):
+        '''The generator given in args, else the one of the package'''
+        for i, arg in enumerate(args):
+            if arg == '-G' and i + 1 < len(args):
+                return args[i + 1], args
+            if arg.startswith('-G'):
+                return arg[2:], args
+        generator = self.generator
+        if generator is None:
+            try:
+                find_file('ninja', self.env['PATH'])
+                generator = 'Ninja'
+            except Exception:
+                generator = 'Unix Makefiles'
+        return generator, list(args) + ['-G', generator]
+
     @stage
     def configure(self, other=(), enable=(), disable=(), with_=(), without=()):
         # The tradition is to use "build", but some tools include a
@@ -657,14 +2067,17 @@ class CMakePackage(Package):
         # Some of these build rules were breaking recent packages (ISIS etc) so they had to be turned off.
         #  If it breaks something else then we will find out why these changes were there!
 
-        # Write out a custom cmake rules file
+        # Write out a custom cmake rules file. It is shared by all the
+        # packages, so it is only replaced when it changes, and at once.
         build_rules = P.join(self.env['BUILD_DIR'], 'my_rules.cmake')
-        with open(build_rules, 'w') as f:
-            print('SET (CMAKE_C_COMPILER "%s" CACHE FILEPATH "C compiler" FORCE)' % (find_file(self.env['CC'], self.env['PATH'])), file=f)
-            #print('SET (CMAKE_C_COMPILE_OBJECT "<CMAKE_C_COMPILER> <DEFINES> %s <FLAGS> -o <OBJECT> -c <SOURCE>" CACHE STRING "C compile command" FORCE)' % (self.env.get('CPPFLAGS', '')), file=f)
-            print('SET (CMAKE_CXX_COMPILER "%s" CACHE FILEPATH "C++ compiler" FORCE)' % (find_file(self.env['CXX'], self.env['PATH'])), file=f)
-            print('SET (CMAKE_Fortran_COMPILER "%s" CACHE FILEPATH "Fortran compiler" FORCE)' % (find_file(self.env['GFORTRAN'], self.env['PATH'])), file=f)
-            #print('SET (CMAKE_CXX_COMPILE_OBJECT "<CMAKE_CXX_COMPILER> <DEFINES> %s <FLAGS> -o <OBJECT> -c <SOURCE>" CACHE STRING "C++ compile command" FORCE)' % (self.env.get('CPPFLAGS', '')), file=f)
+        rules = [
+            'SET (CMAKE_C_COMPILER "%s" CACHE FILEPATH "C compiler" FORCE)' % (find_file(self.env['CC'], self.env['PATH'])),
+            #'SET (CMAKE_C_COMPILE_OBJECT "<CMAKE_C_COMPILER> <DEFINES> %s <FLAGS> -o <OBJECT> -c <SOURCE>" CACHE STRING "C compile command" FORCE)' % (self.env.get('CPPFLAGS', '')),
+            'SET (CMAKE_CXX_COMPILER "%s" CACHE FILEPATH "C++ compiler" FORCE)' % (find_file(self.env['CXX'], self.env['PATH'])),
+            'SET (CMAKE_Fortran_COMPILER "%s" CACHE FILEPATH "Fortran compiler" FORCE)' % (find_file(self.env['GFORTRAN'], self.env['PATH'])),
+            #'SET (CMAKE_CXX_COMPILE_OBJECT "<CMAKE_CXX_COMPILER> <DEFINES> %s <FLAGS> -o <OBJECT> -c <SOURCE>" CACHE STRING "C++ compile command" FORCE)' % (self.env.get('CPPFLAGS', '')),
+        ]
+        write_if_changed(build_rules, '\n'.join(rules) + '\n')
 
         # Build up the main cmake command using our environment variables
         cmd = ['cmake']
@@ -697,26 +2110,605 @@ class CMakePackage(Package):
         ])
 
         [args.append(arg) for arg in other]
+        generator, args = self._generator(args)
 
         try:
             os.makedirs(self.builddir)
         except OSError as e:
             pass
 
+        # CMake refuses to switch the generator of a build dir
+        cache = P.join(self.builddir, 'CMakeCache.txt')
+        if JobServer._cmake_generator(['--build', self.builddir]) not in (None, generator):
+            os.remove(cache)
+            trash.remove(P.join(self.builddir, 'CMakeFiles'))
+
         cmd = cmd + args + [self.workdir]
 
+        # Nothing to do if cmake was already run on the same inputs, as in
+        # fast rebuilds of git packages. The build runs cmake again anyway
+        # if it sees the need.
+        inputs = self._configure_inputs(cmd, build_rules)
+        done_file = P.join(self.builddir, '.binarybuilder-configure')
+        build_file = 'build.ninja' if generator == 'Ninja' else 'Makefile'
+        try:
+            with open(done_file) as f:
+                done = f.read().strip()
+        except IOError:
+            done = None
+        if done == inputs and P.isfile(P.join(self.builddir, 'CMakeCache.txt')) \
+               and P.isfile(P.join(self.builddir, build_file)):
+            info('The cmake inputs of %s did not change, skipping configure' % self.pkgname)
+            return
+        if done is not None:
+            os.remove(done_file)
+
         # Finally, run the cmake command!
         self.helper(*cmd, cwd=self.builddir)
 
+        write_if_changed(done_file, inputs + '\n')
+
+    def _configure_inputs(self, cmd, build_rules):
+        '''A hash of everything the outcome of cmake depends on: its
+           arguments, the rules file, the environment, and the names and
+           modification times of the CMake files of the package'''
+        h = sha1()
+        def add(*items):
+            for item in items:
+                if not isinstance(item, bytes):
+                    item = str(item).encode('utf-8')
+                h.update(item)
+                h.update(b'\0')
+        add(*cmd)
+        with open(build_rules, 'rb') as f:
+            add(f.read())
+        for var in sorted(self.env):
+            if var not in STAMP_IGNORE_ENV:
+                add(var, self.env[var])
+        builddir = P.realpath(self.builddir)
+        for dirname, dirs, files in os.walk(self.workdir):
+            dirs[:] = sorted(d for d in dirs if d != '.git' and
+                             P.realpath(P.join(dirname, d)) != builddir)
+            for name in sorted(files):
+                if name == 'CMakeLists.txt' or name.endswith('.cmake'):
+                    path = P.join(dirname, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    add(P.relpath(path, self.workdir), st.st_size, st.st_mtime)
+        return h.hexdigest()
+
+    def cmake_build(self, target=None):
+        '''Build a target, all by default, with whichever tool CMake
+           generated the build for'''
+        cmd = ['cmake', '--build', self.builddir]
+        if target is not None:
+            cmd += ['--target', target]
+        # Only the number of jobs: MAKEOPTS may set make variables too,
+        # which Ninja would take for targets.
+        m = re.search(r'(?:^|\s)(?:-j\s*|--jobs[=\s]\s*)(\d+)', self.env.get('MAKEOPTS', ''))
+        if m:
+            cmd += ['--', '-j%s' % m.group(1)]
+        self.helper(*cmd, cwd=self.builddir)
+
     @stage
     def compile(self):
-        '''Compile works the same as the base class'''
-        super(CMakePackage, self).compile(cwd=self.builddir)
+        '''Compile with cmake --build, in parallel'''
+        self.cmake_build()
 
     @stage
     def install(self):
-        '''Install works the same as the base class'''
-        super(CMakePackage, self).install(cwd=self.builddir)
+        '''Install with cmake --install, or the install target before
+           CMake 3.15'''
+        if cmake_version(self.env) >= (3, 15):
+            self.helper('cmake', '--install', self.builddir, cwd=self.builddir)
+        else:
+            self.cmake_build('install')
+
+PackageInfo = namedtuple('PackageInfo', 'name kind src chksum patches deps cacheable')
+
+class PackageRegistry(object):
+    '''The package classes of a module, by name, and what can be told about
+       them without making Package objects, which copy the environment and
+       may ask servers for the latest commits.'''
+
+    def __init__(self, module, osbits=None):
+        self.osbits = osbits # Picks src and chksum from a PLATFORM table
+        self.classes = OrderedDict()
+        for name in sorted(dir(module)):
+            klass = getattr(module, name)
+            if isinstance(klass, type) and issubclass(klass, Package) and \
+                   klass.__module__ == module.__name__:
+                self.classes[name] = klass
+
+    def __contains__(self, name):
+        return name in self.classes
+
+    def __iter__(self):
+        return iter(self.classes)
+
+    def get(self, name):
+        '''The class of the package name, or None'''
+        return self.classes.get(name)
+
+    @staticmethod
+    def _attr(klass, attr):
+        '''A class attribute, None if it is only known to objects'''
+        value = getattr(klass, attr, None)
+        return None if isinstance(value, property) else value
+
+    def info(self, name):
+        '''The PackageInfo of the package name, or None if there is no such
+           package. A chksum of None for a git package means the latest
+           commit on master.'''
+        klass = self.get(name)
+        if klass is None:
+            return None
+        src    = self._attr(klass, 'src')
+        chksum = self._attr(klass, 'chksum')
+        platform = getattr(klass, 'PLATFORM', None)
+        if isinstance(platform, dict) and self.osbits in platform:
+            src    = platform[self.osbits].get('src', src)
+            chksum = platform[self.osbits].get('chksum', chksum)
+        kind = [k.__name__ for k in klass.__mro__
+                if k.__module__ == Package.__module__ and issubclass(k, Package) and k is not Package]
+        return PackageInfo(
+            name      = name,
+            kind      = kind or ['Package'],
+            src       = src,
+            chksum    = chksum,
+            patches   = self._attr(klass, 'patches'),
+            deps      = klass.dependencies(),
+            cacheable = klass.cacheable,
+            )
+
+def build_graph(pkgs):
+    '''For each package class in pkgs, find the packages in pkgs it must
+       wait for. Dependencies which are not in pkgs are assumed to be
+       available already (built earlier, or provided by conda).'''
+    names = dict((pkg.__name__, pkg) for pkg in pkgs)
+    graph = {}
+    for pkg in pkgs:
+        graph[pkg] = [names[dep] for dep in pkg.dependencies()
+                      if dep in names and names[dep] is not pkg]
+    return graph
+
+def run_graph(pkgs, func, jobs=1):
+    '''Call func(pkg) for each package in pkgs, running at most jobs of
+       them at the same time. A package is started only after all the
+       packages it depends on have finished. Among the packages which
+       are ready, the ones earlier in pkgs go first. On failure no new
+       packages are started, the running ones are allowed to finish,
+       and the first error is raised.'''
+    graph   = build_graph(pkgs)
+    pending = list(pkgs)
+    done    = set()
+    running = set()
+    errors  = []
+    cond    = threading.Condition()
+
+    def ready():
+        return [pkg for pkg in pending if all(dep in done for dep in graph[pkg])]
+
+    if jobs <= 1:
+        # Keep it simple, and keep the tracebacks readable
+        while pending:
+            batch = ready()
+            if not batch:
+                raise Exception('Circular dependency among packages: %s' %
+                                ' '.join(pkg.__name__ for pkg in pending))
+            pkg = batch[0]
+            pending.remove(pkg)
+            func(pkg)
+            done.add(pkg)
+        return
+
+    def worker(pkg):
+        error = None
+        try:
+            func(pkg)
+        except BaseException:
+            error = sys.exc_info()
+        with cond:
+            running.discard(pkg)
+            if error is None:
+                done.add(pkg)
+            else:
+                errors.append(error)
+            cond.notify_all()
+
+    with cond:
+        while pending or running:
+            if not errors:
+                for pkg in ready():
+                    if len(running) >= jobs:
+                        break
+                    pending.remove(pkg)
+                    running.add(pkg)
+                    t = threading.Thread(target=worker, args=(pkg,),
+                                         name=pkg.__name__)
+                    t.daemon = True
+                    t.start()
+            if not running:
+                if errors:
+                    break
+                if pending:
+                    raise Exception('Circular dependency among packages: %s' %
+                                    ' '.join(pkg.__name__ for pkg in pending))
+            cond.wait()
+
+    if errors:
+        raise errors[0][1]
+
+def run_pool(items, func, jobs=1, key=None, per_key=None):
+    '''Call func(item) for each item, running up to jobs of them at the
+       same time, in no particular order of completion. If key is given,
+       no more than per_key items with the same key(item) run at once
+       (say, downloads from the same server). Unlike run_graph, a failure
+       does not stop the other items; the first error is raised once they
+       are all done.'''
+    pending = list(items)
+    active  = {}
+    errors  = []
+    cond    = threading.Condition()
+    if key is None:
+        key = lambda item: None
+    if not per_key:
+        per_key = jobs
+
+    def next_item():
+        # Called with cond held
+        while pending:
+            for item in pending:
+                if active.get(key(item), 0) < per_key:
+                    pending.remove(item)
+                    active[key(item)] = active.get(key(item), 0) + 1
+                    return item
+            cond.wait()
+        return None
+
+    def worker():
+        while True:
+            with cond:
+                item = next_item()
+            if item is None:
+                return
+            try:
+                func(item)
+            except BaseException:
+                with cond:
+                    errors.append(sys.exc_info())
+            with cond:
+                active[key(item)] -= 1
+                cond.notify_all()
+
+    threads = [threading.Thread(target=worker) for i in range(max(min(jobs, len(pending)), 1))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        while t.is_alive():
+            t.join(1.0) # Not a bare join(), so ctrl-c still works
+
+    if errors:
+        raise errors[0][1]
+
+class JobServer(object):
+    '''A GNU make jobserver shared by all the packages being built, so
+       that no matter how many packages are built at the same time, no more
+       than "jobs" compile processes run at once. The tokens live in a
+       named pipe. Each package holds one token while it is being built
+       (the implicit job slot of its make), and make, cmake --build and
+       ninja borrow the others through MAKEFLAGS. Tools which can't talk
+       to a jobserver (bjam, older ninja) get as many tokens as are free
+       when they start, and give them back when they are done.'''
+
+    def __init__(self, jobs, dirname):
+        self.jobs = max(int(jobs), 1)
+        mkdir_f(dirname)
+        self.path = P.join(dirname, 'jobserver.%d.fifo' % os.getpid())
+        if P.exists(self.path):
+            os.unlink(self.path)
+        os.mkfifo(self.path, 0o600)
+        # Opening for writing first makes sure the read opens don't block.
+        # The fds given to children are blocking, like the pipe make
+        # itself would create, while we poll on a separate, non-blocking,
+        # open file description so that we never hang on a token someone
+        # else grabbed first.
+        self.write_fd = os.open(self.path, os.O_RDWR)
+        self.read_fd  = os.open(self.path, os.O_RDONLY)
+        self.poll_fd  = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+        os.write(self.write_fd, b'+' * self.jobs)
+        self._ninja = None
+
+    def close(self):
+        for fd in (self.poll_fd, self.read_fd, self.write_fd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        if P.exists(self.path):
+            os.unlink(self.path)
+
+    def _take(self):
+        '''Grab a token if one is free, else return None.'''
+        try:
+            token = os.read(self.poll_fd, 1)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return None
+            raise
+        return token or None
+
+    def acquire(self):
+        '''Wait for a token and return it.'''
+        while True:
+            token = self._take()
+            if token is not None:
+                return token
+            select.select([self.poll_fd], [], [], 1.0)
+
+    def release(self, tokens):
+        if tokens:
+            os.write(self.write_fd, tokens)
+
+    def reserve(self):
+        '''Grab all the tokens which are free right now, without waiting.'''
+        tokens = b''
+        while len(tokens) < self.jobs - 1:
+            token = self._take()
+            if token is None:
+                break
+            tokens += token
+        return tokens
+
+    def slot(self):
+        '''Context manager holding one token. The scheduler wraps each
+           package in it, which stands in for the token make assumes
+           it has without reading it from the pipe.'''
+        server = self
+        class _Slot(object):
+            def __enter__(self):
+                self.token = server.acquire()
+            def __exit__(self, *unused):
+                server.release(self.token)
+        return _Slot()
+
+    def makeflags(self):
+        # Both spellings, make < 4.2 only knows --jobserver-fds
+        return ' -j%d --jobserver-fds=%d,%d --jobserver-auth=%d,%d' % \
+               (self.jobs, self.read_fd, self.write_fd, self.read_fd, self.write_fd)
+
+    def ninja_has_jobserver(self):
+        '''Ninja is a jobserver client starting with version 1.13.'''
+        if self._ninja is None:
+            self._ninja = False
+            try:
+                out = subprocess.Popen(['ninja', '--version'], stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE).communicate()[0]
+                ver = tuple(int(v) for v in re.findall(r'\d+', out.decode('utf-8'))[:2])
+                self._ninja = ver >= (1, 13)
+            except (OSError, ValueError):
+                pass
+        return self._ninja
+
+    @staticmethod
+    def _strip_jobs(args):
+        '''Remove -jN, -j N, --jobs=N and --parallel N style flags.'''
+        out  = []
+        skip = False
+        for arg in args:
+            if skip:
+                skip = False
+                if arg.isdigit():
+                    continue
+            if arg in ('-j', '--jobs', '--parallel'):
+                skip = True
+                continue
+            if re.match(r'^(-j\d+|--jobs=\d*|--parallel=?\d+)$', arg):
+                continue
+            out.append(arg)
+        return out
+
+    @staticmethod
+    def _cmake_generator(args):
+        '''Find the generator used in the build dir passed to cmake --build.'''
+        builddir = args[args.index('--build') + 1]
+        try:
+            with open(P.join(builddir, 'CMakeCache.txt')) as f:
+                for line in f:
+                    if line.startswith('CMAKE_GENERATOR:'):
+                        return line.split('=', 1)[1].strip()
+        except (IOError, OSError):
+            pass
+        return None
+
+    def prepare(self, args, kw):
+        '''Rewrite a command about to be run so it takes its jobs from this
+           jobserver. Returns the new args and the tokens to give back
+           once the command is done.'''
+        tool   = P.basename(args[0])
+        client = False
+        extra  = None
+        if tool in ('make', 'gmake'):
+            client = True
+        elif tool == 'ninja':
+            client = self.ninja_has_jobserver()
+            if not client:
+                extra = '-j%d'
+        elif tool == 'cmake' and '--build' in args:
+            client = True
+            if self._cmake_generator(args) == 'Ninja' and not self.ninja_has_jobserver():
+                client = False
+                extra  = '-j%d'
+        elif tool in ('bjam', 'b2'):
+            extra = '-j%d'
+
+        if not client and extra is None:
+            return args, b''
+
+        args = self._strip_jobs(args)
+        tokens = b''
+        if client:
+            env = dict(kw['env'])
+            env['MAKEFLAGS'] = self.makeflags()
+            env.pop('MFLAGS', None)
+            kw['env'] = env
+            if sys.version_info >= (3, 2):
+                kw['pass_fds'] = tuple(kw.get('pass_fds', ())) + (self.read_fd, self.write_fd)
+            else:
+                kw['close_fds'] = False
+        else:
+            tokens = self.reserve()
+            jobs = extra % (len(tokens) + 1)
+            if tool == 'cmake':
+                if '--' not in args:
+                    args.append('--')
+                args.append(jobs)
+            else:
+                args.insert(1, jobs)
+        return args, tokens
+
+_jobserver = None
+
+def set_jobserver(server):
+    '''Make all the packages take their build jobs from this JobServer.'''
+    global _jobserver
+    _jobserver = server
+
+def get_jobserver():
+    return _jobserver
+
+class CompilerCache(object):
+    '''ccache or sccache in front of the C and C++ compilers. The compilers
+       are replaced in the PATH by scripts of the same name which run them
+       through the cache, so CC=gcc stays gcc to configure scripts, cmake
+       and the artifact cache keys. The cache directory and its size limit
+       are shared by all the build roots which use it.
+
+       The hits and misses of each package are counted from its own
+       stats log with ccache 4.4 and later. Otherwise they are read from
+       the counters of the whole cache, which mixes up the packages
+       built at the same time.'''
+
+    HITS   = ('direct_cache_hit', 'preprocessed_cache_hit')
+    MISSES = ('cache_miss',)
+
+    def __init__(self, program, cache_dir, max_size=None):
+        self.program  = program
+        self.name     = P.basename(program)
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.stats_log = False
+        if self.name == 'ccache':
+            version = re.search(r'(\d+)\.(\d+)', run(program, '--version'))
+            self.stats_log = version is not None and \
+                             (int(version.group(1)), int(version.group(2))) >= (4, 4)
+
+    @classmethod
+    def find(cls, cache_dir, max_size=None):
+        '''The first of ccache and sccache which is installed, or None'''
+        for name in ('ccache', 'sccache'):
+            program = which(name)
+            if program is not None:
+                return cls(program, cache_dir, max_size)
+        return None
+
+    def setup(self, env, compiler_dir):
+        '''Point env at the cache and put wrappers for CC and CXX in
+           compiler_dir, in front of the PATH of env'''
+        mkdir_f(self.cache_dir)
+        if self.name == 'ccache':
+            env['CCACHE_DIR'] = self.cache_dir
+            # Hits across build roots: paths under the build root are
+            # hashed relative to the current directory
+            env['CCACHE_BASEDIR'] = P.dirname(env['BUILD_DIR'])
+            env['CCACHE_NOHASHDIR'] = '1'
+            if self.max_size:
+                run(self.program, '-M', self.max_size, env=env)
+        else:
+            env['SCCACHE_DIR'] = self.cache_dir
+            if self.max_size:
+                env['SCCACHE_CACHE_SIZE'] = self.max_size
+            # The server reads its settings when it starts
+            run(self.program, '--stop-server', env=env, raise_on_failure=False)
+            run(self.program, '--start-server', env=env)
+
+        mkdir_f(compiler_dir)
+        for var in ('CC', 'CXX'):
+            compiler = env[var]
+            if not P.isabs(compiler):
+                try:
+                    compiler = find_file(compiler, env['PATH'])
+                except Exception:
+                    continue # build.py complains about it
+            wrapper = P.join(compiler_dir, P.basename(env[var]))
+            with open(wrapper, 'w') as f:
+                f.write('#!/bin/sh\nexec "%s" "%s" "$@"\n' % (self.program, compiler))
+            os.chmod(wrapper, 0o755)
+            if P.isabs(env[var]):
+                env[var] = wrapper
+        env['PATH'] = compiler_dir + os.pathsep + env['PATH']
+
+    def prepare(self, pkg):
+        '''Give a package its own stats log, where ccache can do it'''
+        if self.stats_log:
+            dirname = P.join(pkg.env['MISC_DIR'], 'compiler-cache')
+            mkdir_f(dirname)
+            pkg.env['CCACHE_STATSLOG'] = P.join(dirname, pkg.pkgname + '.log')
+
+    def counters(self, env):
+        '''The number of cache hits and misses so far, of the package with
+           this environment if it has a stats log'''
+        hits = misses = 0
+        if env.get('CCACHE_STATSLOG'):
+            try:
+                with open(env['CCACHE_STATSLOG']) as f:
+                    for line in f:
+                        line = line.strip()
+                        if line in self.HITS:
+                            hits += 1
+                        elif line in self.MISSES:
+                            misses += 1
+            except IOError:
+                pass
+            return hits, misses
+
+        if self.name == 'sccache':
+            out = run(self.program, '--show-stats', '--stats-format', 'json',
+                      env=env, raise_on_failure=False)
+            try:
+                stats = json.loads(out)['stats']
+            except (TypeError, ValueError, KeyError):
+                return hits, misses
+            def count(value):
+                if isinstance(value, dict):
+                    return sum(value.get('counts', {}).values())
+                return int(value)
+            return count(stats.get('cache_hits', 0)), count(stats.get('cache_misses', 0))
+
+        out = run(self.program, '--print-stats', env=env, raise_on_failure=False)
+        if not isinstance(out, string_types):
+            return hits, misses # Failed, or too old for --print-stats
+        for line in out.splitlines():
+            fields = line.split('\t')
+            if len(fields) == 2 and fields[1].isdigit():
+                if fields[0] in self.HITS:
+                    hits += int(fields[1])
+                elif fields[0] in self.MISSES:
+                    misses += int(fields[1])
+        return hits, misses
+
+_compiler_cache = None
+
+def set_compiler_cache(cache):
+    '''Build all the packages with this CompilerCache'''
+    global _compiler_cache
+    _compiler_cache = cache
+
+def get_compiler_cache():
+    return _compiler_cache
 
 # TODO: Duplicated in Packages.py!
 def print_qt_config(cppflags, config, bindir, includedir, libdir):
@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+
+from __future__ import with_statement, print_function
+
+import inspect
+import json
+import os
+import os.path as P
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+
+from hashlib import sha1
+
+if sys.version_info < (3, 0, 0):
+    # Python 2
+    from urllib2 import urlopen, Request, HTTPError
+    from urlparse import urlparse
+else:
+    # Python 3
+    from urllib.request import urlopen, Request
+    from urllib.error import HTTPError
+    from urllib.parse import urlparse
+
+from BinaryBuilder import Package, info, warn
+from BinaryDist import mkdir_f
+
+# Bump this to throw away all the artifacts made by an older layout
+CACHE_VERSION = '1'
+
+# The parts of the environment which change what a package installs
+KEY_ENV_VARS = ('CC', 'CXX', 'GFORTRAN', 'CFLAGS', 'CXXFLAGS', 'CPPFLAGS',
+                'LDFLAGS', 'ASP_DEPS_DIR', 'OSX_SYSROOT', 'OSX_ARCH', 'OSX_TARGET')
+
+# The directories of the build root, which differ from one build root
+# to the next but don't change what gets built.
+ROOT_DIRS = ('INSTALL_DIR', 'BUILD_DIR', 'DOWNLOAD_DIR', 'MISC_DIR')
+
+class CacheBackend(object):
+    '''Where the artifact cache keeps its files. Names are relative paths
+       like "ab/abcdef....tar.gz". A backend must be safe to use from
+       several threads, and several machines for the shared ones.'''
+
+    def has(self, name):
+        '''Whether the file called name is in the cache'''
+        raise NotImplementedError()
+
+    def get(self, name, output):
+        '''Copy the file called name to the path output. Returns False if
+           it is not in the cache.'''
+        raise NotImplementedError()
+
+    def put(self, name, filename):
+        '''Save the file at path filename as name. Readers must never see
+           a partial file.'''
+        raise NotImplementedError()
+
+class FileCacheBackend(CacheBackend):
+    '''A cache in a local directory, or in one on a shared filesystem'''
+
+    def __init__(self, root):
+        self.root = P.realpath(root)
+        mkdir_f(self.root)
+
+    def __str__(self):
+        return self.root
+
+    def path(self, name):
+        return P.join(self.root, name)
+
+    def has(self, name):
+        return P.isfile(self.path(name))
+
+    def get(self, name, output):
+        if not self.has(name):
+            return False
+        if P.realpath(output) != self.path(name):
+            _atomic_copy(self.path(name), output)
+        return True
+
+    def put(self, name, filename):
+        if P.realpath(filename) != self.path(name):
+            _atomic_copy(filename, self.path(name))
+
+class HttpCacheBackend(CacheBackend):
+    '''A cache on a web server which takes GET, HEAD and PUT requests
+       (cache-server.py, or nginx with the dav module, etc).'''
+
+    def __init__(self, url, timeout=60):
+        self.url = url.rstrip('/') + '/'
+        self.timeout = timeout
+
+    def __str__(self):
+        return self.url
+
+    def _request(self, name, method, data=None, headers={}):
+        req = Request(self.url + name, data=data, headers=headers)
+        req.get_method = lambda: method
+        return urlopen(req, timeout=self.timeout)
+
+    def has(self, name):
+        try:
+            self._request(name, 'HEAD').close()
+            return True
+        except HTTPError as e:
+            if e.code == 404:
+                return False
+            raise
+
+    def get(self, name, output):
+        try:
+            r = self._request(name, 'GET')
+        except HTTPError as e:
+            if e.code == 404:
+                return False
+            raise
+        mkdir_f(P.dirname(output))
+        fd, tmp = tempfile.mkstemp(dir=P.dirname(output), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                shutil.copyfileobj(r, f, 1 << 20)
+            r.close()
+            os.rename(tmp, output)
+        except:
+            os.unlink(tmp)
+            raise
+        return True
+
+    def put(self, name, filename):
+        with open(filename, 'rb') as f:
+            headers = {'Content-Length': str(os.fstat(f.fileno()).st_size),
+                       'Content-Type': 'application/octet-stream'}
+            self._request(name, 'PUT', data=f, headers=headers).close()
+
+def cache_backend(location):
+    '''Make the backend for a URL or a directory'''
+    if urlparse(location).scheme in ('http', 'https'):
+        return HttpCacheBackend(location)
+    return FileCacheBackend(location)
+
+def _atomic_copy(src, dst):
+    mkdir_f(P.dirname(dst))
+    fd, tmp = tempfile.mkstemp(dir=P.dirname(dst), prefix='.tmp-')
+    os.close(fd)
+    try:
+        shutil.copyfile(src, tmp)
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, dst)
+    except:
+        os.unlink(tmp)
+        raise
+
+class ArtifactCache(object):
+    '''A cache of the files each package installs, keyed by everything which
+       goes into building it: its sources, patches, build recipe, compiler
+       flags and the keys of the packages it depends on. With a key hit the
+       package is not built at all, its files are copied into INSTALL_DIR.
+
+       Artifacts always go through the local cache directory. If a remote
+       backend is given, artifacts missing locally are looked for there,
+       and new ones are sent there too unless push is False.'''
+
+    def __init__(self, root, salt='', remote=None, push=True):
+        self.local  = FileCacheBackend(root)
+        self.remote = remote
+        self.push   = push
+        self.salt = salt # compiler versions and such, the same for all packages
+
+    def _flags(self, pkg, var):
+        '''The value of var in the package environment with the parts that
+           depend only on where the build root is taken out.'''
+        env = pkg.env
+        value = env.get(var, '')
+        drop = set()
+        for d in ('lib', 'lib64'):
+            drop.add('-L' + P.join(env['INSTALL_DIR'], d))
+        drop.add('-L' + env['ISIS3RDPARTY'])
+        value = ' '.join(v for v in value.split() if v not in drop)
+        for d in ROOT_DIRS:
+            if env.get(d):
+                value = value.replace(env[d], '@%s@' % d)
+        return value
+
+    def key(self, pkg, dep_keys):
+        '''The cache key of the package instance pkg, or None if it can't be
+           cached. dep_keys are the keys of the packages it depends on.'''
+        if not pkg.cacheable or pkg.chksum is None or None in dep_keys:
+            return None
+        h = sha1()
+        def add(*items):
+            for item in items:
+                if not isinstance(item, bytes):
+                    item = str(item).encode('utf-8')
+                h.update(item)
+                h.update(b'\0')
+        add(CACHE_VERSION, self.salt, pkg.pkgname, pkg.arch.os, pkg.arch.machine)
+        add(*sorted(dep_keys))
+        chksum = pkg.chksum
+        if isinstance(chksum, (list, tuple)):
+            add(*chksum)
+        else:
+            add(chksum)
+        downloads = P.abspath(pkg.env['DOWNLOAD_DIR'])
+        for patch in pkg._patch_files():
+            # Those fetched with the sources may not be downloaded yet,
+            # the checksums above stand for them
+            if not P.isfile(patch) or P.dirname(P.abspath(patch)) == downloads:
+                continue
+            with open(patch, 'rb') as f:
+                add(P.basename(patch), f.read())
+        for var in KEY_ENV_VARS:
+            add(var, self._flags(pkg, var))
+        # The build recipe, without the generic classes shared by everyone
+        for klass in type(pkg).__mro__:
+            if klass.__module__ != Package.__module__ and klass is not object:
+                try:
+                    add(inspect.getsource(klass))
+                except (IOError, TypeError):
+                    pass
+        return h.hexdigest()
+
+    @staticmethod
+    def _name(key, ext):
+        return '%s/%s%s' % (key[:2], key, ext)
+
+    def has(self, key):
+        name = self._name(key, '.tar.gz')
+        if self.local.has(name):
+            return True
+        if self.remote is not None:
+            try:
+                return self.remote.has(name)
+            except Exception as e:
+                warn('Cache at %s is not available: %s' % (self.remote, e))
+        return False
+
+    def _fetch(self, key):
+        '''Make sure the artifact for key is in the local cache, getting it
+           from the remote one if needed. Returns False if it is nowhere.'''
+        tarball = self._name(key, '.tar.gz')
+        if self.local.has(tarball):
+            return True
+        if self.remote is None:
+            return False
+        try:
+            # The tarball last, it is what marks the artifact as complete
+            if not self.remote.get(self._name(key, '.json'), self.local.path(self._name(key, '.json'))):
+                return False
+            if not self.remote.get(tarball, self.local.path(tarball)):
+                return False
+        except Exception as e:
+            warn('Could not get %s from the cache at %s: %s' % (tarball, self.remote, e))
+            return False
+        info('Got %s from the cache at %s' % (tarball, self.remote))
+        return True
+
+    def store(self, pkg, key, manifest):
+        '''Save the files the InstallManifest of the package lists as the
+           artifact for key.'''
+        install_dir = pkg.env['INSTALL_DIR']
+        files = manifest.existing()
+        if not files:
+            # Most likely not what the package really installs, don't let
+            # a later build take it for the package being built
+            info('%s installed no files, not saving it to the cache' % pkg.pkgname)
+            return
+
+        tarball = self.local.path(self._name(key, '.tar.gz'))
+        mkdir_f(P.dirname(tarball))
+        fd, tmp = tempfile.mkstemp(dir=P.dirname(tarball), prefix='.tmp-')
+        os.close(fd)
+        try:
+            with tarfile.open(tmp, 'w:gz') as tar:
+                for f in files:
+                    tar.add(P.join(install_dir, f), arcname=f, recursive=False)
+            meta = dict(package=pkg.pkgname, install_dir=install_dir,
+                        files=len(files), created=time.time())
+            meta_file = self.local.path(self._name(key, '.json'))
+            with open(meta_file + '.tmp', 'w') as f:
+                json.dump(meta, f, indent=1)
+            # The tarball goes in last, it is what marks the artifact as complete
+            os.rename(meta_file + '.tmp', meta_file)
+            os.rename(tmp, tarball)
+        except:
+            if P.exists(tmp):
+                os.unlink(tmp)
+            raise
+        info('Saved %d installed files of %s to the cache' % (len(files), pkg.pkgname))
+
+        if self.remote is not None and self.push:
+            try:
+                for ext in ('.json', '.tar.gz'):
+                    self.remote.put(self._name(key, ext), self.local.path(self._name(key, ext)))
+            except Exception as e:
+                warn('Could not send %s to the cache at %s: %s' % (pkg.pkgname, self.remote, e))
+
+    def restore(self, pkg, key):
+        '''Copy the artifact for key into INSTALL_DIR. Returns False if there
+           is none, or it could not be used. The caller holds the install
+           lock, see InstallManifest.installing.'''
+        if not self._fetch(key):
+            return False
+        tarball = self.local.path(self._name(key, '.tar.gz'))
+        install_dir = pkg.env['INSTALL_DIR']
+        try:
+            with open(self.local.path(self._name(key, '.json'))) as f:
+                meta = json.load(f)
+            with tarfile.open(tarball, 'r:*') as tar:
+                members = tar.getmembers()
+                if not members:
+                    info('The artifact of %s in the cache is empty, building it' % pkg.pkgname)
+                    return False
+                self._check_members(members)
+                kw = {}
+                if hasattr(tarfile, 'data_filter'):
+                    kw['filter'] = 'data'
+                tar.extractall(install_dir, **kw)
+                if meta['install_dir'] != install_dir:
+                    self._relocate(install_dir, meta['install_dir'],
+                                   [m.name for m in members if m.isfile()])
+        except Exception as e:
+            warn('Could not restore %s from the cache: %s' % (pkg.pkgname, e))
+            return False
+        info('Restored %s from the cache (%d files)' % (pkg.pkgname, len(members)))
+        return True
+
+    @staticmethod
+    def _check_members(members):
+        '''Raise if an artifact, which may come from a shared cache, has
+           files which would land outside of INSTALL_DIR, or which are not
+           regular files, directories or links'''
+        def inside(name):
+            name = P.normpath(name)
+            return not P.isabs(name) and name != '..' and not name.startswith('..' + os.sep)
+        for m in members:
+            if not inside(m.name):
+                raise Exception('%s is outside of the install dir' % m.name)
+            if m.issym() and not inside(P.join(P.dirname(m.name), m.linkname)):
+                raise Exception('%s links to %s, outside of the install dir' % (m.name, m.linkname))
+            if m.islnk() and not inside(m.linkname):
+                raise Exception('%s links to %s, outside of the install dir' % (m.name, m.linkname))
+            if not (m.isfile() or m.isdir() or m.issym() or m.islnk()):
+                raise Exception('%s is not a regular file' % m.name)
+
+    @staticmethod
+    def _relocate(install_dir, old_dir, files):
+        '''Point the text files which mention the install dir the artifact
+           was made in (libtool .la, pkg-config .pc, cmake config files,
+           scripts, ...) to the current one. Binaries use $ORIGIN.'''
+        old = old_dir.encode('utf-8')
+        new = install_dir.encode('utf-8')
+        for name in files:
+            path = P.join(install_dir, name)
+            with open(path, 'rb') as f:
+                data = f.read()
+            if old not in data or b'\0' in data:
+                continue
+            mode = os.stat(path).st_mode
+            fd, tmp = tempfile.mkstemp(dir=P.dirname(path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data.replace(old, new))
+            os.chmod(tmp, mode)
+            os.rename(tmp, path)
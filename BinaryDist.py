@@ -3,6 +3,7 @@
 import os.path as P
 import logging
 import itertools, shutil, re, errno, sys, os, stat, subprocess, platform, time
+import atexit, json, tempfile, threading
 from os import makedirs, remove, listdir, chmod, symlink, readlink, link
 from collections import namedtuple
 from tempfile import mkdtemp, NamedTemporaryFile
@@ -20,21 +21,130 @@ logger = logging.getLogger()
 def binary_builder_prefix():
     return 'BinaryBuilder'
 
+class HashCache(object):
+    '''The sha1 of files hashed before, kept across runs in a json file.
+       An entry is used only while the file has the same size, mtime and
+       inode as when it was hashed.'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries  = None
+        self.changed  = {}
+        self.lock     = threading.Lock()
+
+    @staticmethod
+    def _stamp(st):
+        mtime_ns = getattr(st, 'st_mtime_ns', None)
+        if mtime_ns is None:
+            mtime_ns = int(st.st_mtime * 1e9)
+        return [st.st_size, mtime_ns, st.st_ino, st.st_dev]
+
+    def _load(self):
+        if self.entries is None:
+            self.entries = {}
+            try:
+                with open(self.filename) as f:
+                    self.entries = json.load(f)
+            except (IOError, OSError, ValueError):
+                pass
+
+    def lookup(self, filename, st):
+        with self.lock:
+            self._load()
+            entry = self.entries.get(P.abspath(filename))
+        if entry is not None and entry[:-1] == self._stamp(st):
+            return entry[-1]
+        return None
+
+    def store(self, filename, st, digest, settled=False):
+        # A file changed within the mtime granularity after we hash it
+        # would look the same, so wait until it has settled. Unless the
+        # digest is of what we just wrote to it ourselves.
+        if not settled and time.time() - st.st_mtime < 2:
+            return
+        with self.lock:
+            self._load()
+            entry = self._stamp(st) + [digest]
+            self.entries[P.abspath(filename)] = entry
+            self.changed[P.abspath(filename)] = entry
+
+    def save(self):
+        '''Write the new entries out, merged with what other processes may
+           have saved in the meantime, dropping the files which are gone.'''
+        with self.lock:
+            if not self.changed:
+                return
+            entries = {}
+            try:
+                with open(self.filename) as f:
+                    entries = json.load(f)
+            except (IOError, OSError, ValueError):
+                pass
+            entries.update(self.changed)
+            entries = dict((k, v) for k, v in entries.items() if P.exists(k))
+            try:
+                mkdir_f(P.dirname(self.filename))
+                fd, tmp = tempfile.mkstemp(dir=P.dirname(self.filename), prefix='.tmp-')
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(entries, f)
+                os.rename(tmp, self.filename)
+            except (IOError, OSError) as e:
+                logger.warn('Could not save the hash cache %s: %s' % (self.filename, e))
+            self.entries = entries
+            self.changed = {}
+
+_hash_cache = HashCache(P.join(os.environ.get('XDG_CACHE_HOME', P.expanduser('~/.cache')),
+                               'binarybuilder', 'hashes.json'))
+atexit.register(_hash_cache.save)
+
 def hash_file(filename):
-    with open(filename, 'rb') as f:
-        return sha1(f.read()).hexdigest()
+    '''The sha1 of a file, read in blocks so that big files don't need to
+       fit in memory, and remembered across runs while the file is unchanged.'''
+    st = os.stat(filename)
+    digest = _hash_cache.lookup(filename, st)
+    if digest is None:
+        h = sha1()
+        with open(filename, 'rb') as f:
+            for block in iter(partial(f.read, 1 << 20), b''):
+                h.update(block)
+        digest = h.hexdigest()
+        _hash_cache.store(filename, st, digest)
+    return digest
+
+def remember_hash(filename, digest):
+    '''Record the sha1 of a file computed some other way, like while
+       downloading it, so hash_file() does not have to read it again.'''
+    _hash_cache.store(filename, os.stat(filename), digest, settled=True)
 
 def run(*args, **kw):
     '''Try to execute a command line command'''
     need_output      = kw.pop('output', False)
     raise_on_failure = kw.pop('raise_on_failure', True)
     want_stderr      = kw.pop('want_stderr', False)
+    on_rusage        = kw.pop('rusage', None)
     kw['stdout']     = kw.get('stdout', subprocess.PIPE)
     kw['stderr']     = kw.get('stderr', subprocess.PIPE)
 
     logger.debug('run: [%s] (wd=%s)' % (' '.join(args), kw.get('cwd', os.getcwd())))
 
     p = subprocess.Popen(args, **kw)
+    if on_rusage is not None and subprocess.PIPE not in \
+           (kw['stdout'], kw['stderr'], kw.get('stdin')):
+        # Reap the child ourselves to get the resources used by it (and
+        # everything it waited for), and only by it. With pipes we would
+        # have to drain them first, leave those to communicate().
+        while True:
+            try:
+                pid, status, usage = os.wait4(p.pid, 0)
+                break
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    raise
+        if os.WIFSIGNALED(status):
+            p.returncode = -os.WTERMSIG(status)
+        else:
+            p.returncode = os.WEXITSTATUS(status)
+        on_rusage(usage)
     out, err = p.communicate()
     if out is not None:
         out = out.decode('utf-8')
@@ -167,22 +277,48 @@ def strip_flag(flag, key, env):
         del env[key]
     return hit, env
 
-def is_ascii(filename):
-    '''Use the "file" tool to determine if a given file is ascii'''
+# The bytes "file" accepts in ASCII text
+TEXT_BYTES = bytes(bytearray([7, 8, 9, 10, 11, 12, 13, 27] + list(range(0x20, 0x7f))))
+
+MACHO_MAGIC = (b'\xfe\xed\xfa\xce', b'\xfe\xed\xfa\xcf', b'\xce\xfa\xed\xfe', b'\xcf\xfa\xed\xfe')
+
+def file_kind(filename):
+    '''What a file is, told from its first bytes the way the "file" tool
+       does, without running it: symlink, elf, macho, archive (ar), script
+       and text (both ASCII), empty, or data for anything else.'''
+    if P.islink(filename):
+        return 'symlink'
     try:
-        ret = run('file', filename, output=True)
-    except:
-       return False
-    return (ret.find('ASCII') != -1)
+        with open(filename, 'rb') as f:
+            head = f.read(1 << 20) # As much as "file" looks at
+    except (IOError, OSError):
+        return 'data'
+    if not head:
+        return 'empty'
+    if head.startswith(b'\x7fELF'):
+        return 'elf'
+    if head[:4] in MACHO_MAGIC:
+        return 'macho'
+    # Fat Mach-O, unless it is a Java class file, which starts the same
+    if head.startswith(b'\xca\xfe\xba\xbe') and len(head) >= 8 and \
+           0 < bytearray(head[4:8])[3] < 20 and head[4:7] == b'\0\0\0':
+        return 'macho'
+    if head.startswith(b'!<arch>\n'):
+        return 'archive'
+    if head.translate(None, TEXT_BYTES):
+        return 'data'
+    if head.startswith(b'#!'):
+        return 'script'
+    return 'text'
+
+def is_ascii(filename):
+    '''Whether a given file is ascii text'''
+    return file_kind(filename) in ('script', 'text')
 
 def is_lib_or_bin_prog(filename):
-    '''Use the "file" tool to determine if a given file is a a library or a binary
-       executable program. Being non-ASCII, on its own, is not enough to qualify.'''
-    try:
-        ret = run('file', filename, output=True)
-    except:
-       return False
-    return (ret.find('ELF') != -1) or (ret.find('Mach-O') != -1)
+    '''Whether a given file is a a library or a binary executable program.
+       Being non-ASCII, on its own, is not enough to qualify.'''
+    return file_kind(filename) in ('elf', 'macho')
 
 def doctest_on(os):
     '''Set up a function wrapper with a warning __doc__ if the provided os does not match?'''
@@ -194,12 +330,15 @@ def doctest_on(os):
         return inner
     return outer
 
-def default_baker(filename, distdir, searchpath):
-    '''Updates a files rpath to be relative to distdir and strips it of symbols'''
-    if is_ascii(filename):
+def default_baker(filename, distdir, searchpath, kind=None):
+    '''Updates a files rpath to be relative to distdir and strips it of
+       symbols. kind is what file_kind() says of it, if known already.'''
+    if kind is None:
+        kind = file_kind(filename)
+    if kind in ('script', 'text'):
         fix_paths(filename)
         return
-    if is_lib_or_bin_prog(filename):
+    if kind in ('elf', 'macho'):
         set_rpath(filename, distdir, searchpath)
 
     # On linux stripping causes the conda libraries to crash
@@ -263,12 +402,21 @@ class DistManager(object):
         self.deplist   = dict() # List of file dependencies
         self.parentlib = dict() # library k is used by parentlib[k]
         self.dst_to_src = dict()
+        self.kinds = dict() # Kind of each source file, if known, see file_kind()
         
         mkdir_f(self.distdir)
         
     def remove_tempdir(self):
         shutil.rmtree(self.tempdir, True)
 
+    def kind(self, filename):
+        '''What kind of file a file in the dist is, as known for the file it
+           was copied from, or else as file_kind() tells'''
+        kind = self.kinds.get(self.dst_to_src.get(filename))
+        if kind is None or P.islink(filename):
+            kind = file_kind(filename)
+        return kind
+
     def add_executable(self, inpath, keep_symlink=True):
         ''' 'inpath' should be a file. This will add the executable to libexec/
             and the wrapper script to bin/ (with the basename of the exe) '''
@@ -433,7 +581,7 @@ class DistManager(object):
         for filename in self.distlist:
             logger.debug('  %s' % filename)
         for filename in self.distlist:
-            baker(filename, self.distdir, searchpath)
+            baker(filename, self.distdir, searchpath, kind=self.kind(filename))
 
         # Delete all hidden files from the self.distdir folder
         for i in run('find', self.distdir, '-name', '.*', '-print0').split('\0'):
@@ -537,7 +685,7 @@ class DistManager(object):
             print("Warning: " + str(e))
             return
         
-        if add_deps and is_lib_or_bin_prog(dst):
+        if add_deps and self.kind(dst) in ('elf', 'macho'):
             # Search for dependencies in our preferred locations first
             search_path = self.asp_install_dir + "/lib" + ":" + self.asp_deps_dir + "/lib"
             req = required_libs(dst, search_path)
@@ -599,7 +747,8 @@ def copy(src, dst, hardlink=False, keep_symlink=True):
     if P.exists(dst):
         # This should happen rarely, normally the problem of which
         # instance of a given file to copy should be solved by now.
-        if hash_file(src) != hash_file(dst):
+        if os.stat(src).st_size != os.stat(dst).st_size or \
+               hash_file(src) != hash_file(dst):
             print("Will overwrite " + dst + " with " + src + " having a different hash.")
 
     if hardlink:
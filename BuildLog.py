@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+'''
+Logs of the commands run by each stage of each package, kept by build.py in
+<build-root>/logs/<package>/<stage>.log.gz, with an index of the compiler
+errors and warnings in them.
+
+The log is written as a series of gzip members, each holding about
+MEMBER_SIZE bytes of output. A gzip file can be made of several members,
+so zcat and zless read it as one, while the index records where each member
+starts. Any line can then be read by decompressing only the member it is in.
+'''
+
+from __future__ import with_statement, print_function
+
+import gzip
+import json
+import os
+import os.path as P
+import re
+import tempfile
+from collections import deque
+
+MEMBER_SIZE = 1 << 20 # Uncompressed bytes of output in each gzip member
+TAIL_LINES  = 100     # Lines kept in memory, to show when a command fails
+MAX_ENTRIES = 10000   # Errors and warnings indexed in one log, at most
+
+ERRORS = re.compile(r':\d+(:\d+)?: (fatal )?error[:\s]|^\S*error: |\*\*\* .*Error \d+|'
+                    r'^CMake Error|^configure: error:|undefined reference to|'
+                    r'^ld: |collect2: error|^FAILED: |^Traceback ')
+WARNINGS = re.compile(r':\d+(:\d+)?: warning:|^CMake Warning|^configure: WARNING:')
+
+class StageLog(object):
+    '''The log of one stage of a package. Lines are written to it as the
+       commands print them.'''
+
+    def __init__(self, log_dir, pkgname, stage):
+        dirname = P.join(log_dir, pkgname)
+        if not P.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                if not P.isdir(dirname):
+                    raise
+        self.path  = P.join(dirname, stage + '.log.gz')
+        self.index_path = P.join(dirname, stage + '.idx.json')
+        self.file  = open(self.path, 'wb')
+        self.member = None
+        self.member_size = 0
+        self.offset  = 0 # Uncompressed bytes written so far
+        self.line_no = 0
+        self.members = [] # (uncompressed offset, compressed offset) of each member
+        self.entries = []
+        self.counts  = dict(error=0, warning=0)
+        self.tail = deque(maxlen=TAIL_LINES)
+
+    def write(self, line):
+        '''Add a line of output, which ends with a newline'''
+        if isinstance(line, bytes):
+            data = line
+            line = line.decode('utf-8', 'replace')
+        else:
+            data = line.encode('utf-8')
+        if self.member is None or self.member_size >= MEMBER_SIZE:
+            self._new_member()
+        self.member.write(data)
+        self.member_size += len(data)
+
+        text = line.rstrip('\n')
+        self.tail.append(text)
+        kind = None
+        if ERRORS.search(text):
+            kind = 'error'
+        elif WARNINGS.search(text):
+            kind = 'warning'
+        if kind is not None:
+            self.counts[kind] += 1
+            if len(self.entries) < MAX_ENTRIES:
+                self.entries.append(dict(kind=kind, offset=self.offset,
+                                         line=self.line_no + 1, text=text[:300]))
+        self.offset  += len(data)
+        self.line_no += 1
+
+    def _new_member(self):
+        if self.member is not None:
+            self.member.close() # Closes the member, not the file
+        self.members.append((self.offset, self.file.tell()))
+        self.member = gzip.GzipFile(fileobj=self.file, mode='wb', mtime=0)
+        self.member_size = 0
+
+    def close(self):
+        if self.member is not None:
+            self.member.close()
+            self.member = None
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        index = dict(log=P.basename(self.path), lines=self.line_no, size=self.offset,
+                     members=self.members, counts=self.counts, entries=self.entries)
+        fd, tmp = tempfile.mkstemp(dir=P.dirname(self.index_path), prefix='.tmp-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(index, f)
+        os.rename(tmp, self.index_path)
+
+def read_lines(log_path, members, offset, count):
+    '''Up to count lines of a log starting at the line at the uncompressed
+       offset, decompressing only from the member that holds it'''
+    start = (0, 0)
+    for member in members:
+        if member[0] <= offset:
+            start = member
+    lines = []
+    with open(log_path, 'rb') as raw:
+        raw.seek(start[1])
+        with gzip.GzipFile(fileobj=raw, mode='rb') as f:
+            pos = start[0]
+            for line in f:
+                if pos >= offset:
+                    lines.append(line.decode('utf-8', 'replace').rstrip('\n'))
+                    if len(lines) >= count:
+                        break
+                pos += len(line)
+    return lines
+
+def show_errors(log_dir, pkgname, stages, context=3, warnings=False):
+    '''Print the errors (and warnings if asked) found in the logs of a
+       package, each with the lines which follow it. Returns the number of
+       errors.'''
+    dirname = P.join(log_dir, pkgname)
+    found = 0
+    seen_any = False
+    for stage in stages:
+        index_path = P.join(dirname, stage + '.idx.json')
+        if not P.exists(index_path):
+            continue
+        seen_any = True
+        with open(index_path) as f:
+            index = json.load(f)
+        log_path = P.join(dirname, index['log'])
+        print('%s: %d errors, %d warnings in %d lines' %
+              (log_path, index['counts']['error'], index['counts']['warning'], index['lines']))
+        for entry in index['entries']:
+            if entry['kind'] != 'error' and not warnings:
+                continue
+            found += entry['kind'] == 'error'
+            print('\n--- %s.%s line %d (%s):' % (pkgname, stage, entry['line'], entry['kind']))
+            for line in read_lines(log_path, index['members'], entry['offset'], context + 1):
+                print('  ' + line)
+    if not seen_any:
+        print('No logs for %s in %s' % (pkgname, dirname))
+    return found
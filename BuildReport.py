@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+'''
+Reports on the stage stats recorded by build.py in <build-root>/stats.jsonl.
+'''
+
+from __future__ import with_statement, print_function
+
+import json
+from collections import OrderedDict
+
+STAGES = ('restore', 'fetch', 'unpack', 'configure', 'compile', 'install')
+
+def load_stats(filename, run=None):
+    '''Read the records of one run from a stats file, the last run if none
+       is given. Returns the run and its records, in the order written.'''
+    records = []
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                pass # A line cut short by an interrupted build
+    if run is None and records:
+        run = records[-1].get('run', '')
+    return run, [r for r in records if r.get('run', '') == run]
+
+def package_times(records):
+    '''Group stage records by package. For each package, give the total
+       wall time of its stages, when it started and ended, the wall time
+       of each stage, and how often it retried talking to a server.'''
+    times = OrderedDict()
+    for r in records:
+        t = times.setdefault(r['package'], dict(wall=0.0, start=r['start'], end=r['end'],
+                                               stages=OrderedDict(), ok=True,
+                                               cc_hits=None, cc_misses=None,
+                                               retries=0, retry_wait=0.0))
+        t['wall']  += r['wall']
+        t['start']  = min(t['start'], r['start'])
+        t['end']    = max(t['end'],   r['end'])
+        t['ok']     = t['ok'] and r.get('ok', True)
+        t['stages'][r['stage']] = t['stages'].get(r['stage'], 0.0) + r['wall']
+        t['retries']    += r.get('retries', 0)
+        t['retry_wait'] += r.get('retry_wait', 0.0)
+        for k in ('cc_hits', 'cc_misses'):
+            if k in r:
+                t[k] = (t[k] or 0) + r[k]
+    return times
+
+def dependency_graph(names, lookup):
+    '''Map each package name to the names, among names, of the packages it
+       depends on. lookup gives the package class for a name, or None.'''
+    graph = OrderedDict()
+    for name in names:
+        klass = lookup(name)
+        deps = klass.dependencies() if klass is not None and hasattr(klass, 'dependencies') else []
+        graph[name] = [d for d in deps if d in names and d != name]
+    return graph
+
+def critical_path(times, graph):
+    '''The chain of dependent packages with the largest total wall time.
+       Returns its length and the package names along it.'''
+    finish = {}
+    before = {}
+    def visit(name, stack=()):
+        if name in finish:
+            return finish[name]
+        if name in stack:
+            return 0.0 # Circular dependencies, don't go round forever
+        best = 0.0
+        before[name] = None
+        for dep in graph[name]:
+            t = visit(dep, stack + (name,))
+            if t > best:
+                best = t
+                before[name] = dep
+        finish[name] = best + times[name]['wall']
+        return finish[name]
+
+    end = None
+    for name in graph:
+        if visit(name) > finish.get(end, -1.0):
+            end = name
+    path = []
+    while end is not None:
+        path.append(end)
+        end = before[end]
+    path.reverse()
+    return (finish[path[-1]] if path else 0.0), path
+
+def simulate(times, graph, slots):
+    '''How long building the packages would take with this many packages
+       built at the same time, each taking the time it took, starting
+       first the ready packages with the longest chain of packages waiting
+       on them.'''
+    # Length of the longest chain from each package to the end of the build
+    users = dict((name, []) for name in graph)
+    for name, deps in graph.items():
+        for dep in deps:
+            users[dep].append(name)
+    rank = {}
+    def chain(name, stack=()):
+        if name not in rank:
+            if name in stack:
+                return 0.0
+            rank[name] = times[name]['wall'] + \
+                         max([chain(u, stack + (name,)) for u in users[name]] or [0.0])
+        return rank[name]
+    for name in graph:
+        chain(name)
+
+    now     = 0.0
+    done    = set()
+    running = [] # (end time, name)
+    pending = list(graph)
+    while pending or running:
+        ready = [n for n in pending if all(d in done for d in graph[n])]
+        ready.sort(key=lambda n: -rank[n])
+        for name in ready[:max(slots - len(running), 0)]:
+            pending.remove(name)
+            running.append((now + times[name]['wall'], name))
+        if not running:
+            break # Circular dependencies among the rest
+        running.sort()
+        now, name = running.pop(0)
+        done.add(name)
+    return now
+
+def chrome_trace(records):
+    '''The records as a Chrome trace (chrome://tracing, ui.perfetto.dev).
+       Each package gets a span with its stages nested in it, on the first
+       row free when it started, so the rows show what ran in parallel.'''
+    times = package_times(records)
+    if not times:
+        return dict(traceEvents=[], displayTimeUnit='ms')
+    t0 = min(t['start'] for t in times.values())
+    us = lambda t: int(round((t - t0) * 1e6))
+
+    events = []
+    lanes  = [] # End time of the last package on each row
+    row_of = {}
+    for name, t in sorted(times.items(), key=lambda item: item[1]['start']):
+        for row, end in enumerate(lanes):
+            if end <= t['start']:
+                break
+        else:
+            row = len(lanes)
+            lanes.append(0.0)
+        lanes[row] = t['end']
+        row_of[name] = row
+        events.append(dict(name=name, cat='package', ph='X', pid=1, tid=row,
+                           ts=us(t['start']), dur=us(t['end']) - us(t['start']),
+                           args=dict(ok=t['ok'])))
+    for r in records:
+        args = dict((k, r[k]) for k in ('user', 'sys', 'maxrss_kb', 'install_bytes', 'ok',
+                                        'cc_hits', 'cc_misses', 'retries', 'retry_wait') if k in r)
+        events.append(dict(name=r['stage'], cat=r['package'], ph='X', pid=1,
+                           tid=row_of[r['package']], ts=us(r['start']),
+                           dur=us(r['end']) - us(r['start']), args=args))
+    for row in range(len(lanes)):
+        events.append(dict(name='thread_name', ph='M', pid=1, tid=row,
+                           args=dict(name='slot %d' % row)))
+    return dict(traceEvents=events, displayTimeUnit='ms')
+
+def _fmt(seconds):
+    m, s = divmod(int(round(seconds)), 60)
+    h, m = divmod(m, 60)
+    return '%d:%02d:%02d' % (h, m, s)
+
+def report(stats_file, lookup, trace_file=None, run=None, slots=(1, 2, 4, 8, 16, 32)):
+    '''Print where the time of a build went: each package's share, its
+       compiler cache hits and misses, the time spent waiting to retry
+       talking to servers, the critical path through the
+       dependency graph, and how much faster the build could be with more
+       packages built at once. Also write a Chrome trace of it to
+       trace_file, if given.'''
+    run, records = load_stats(stats_file, run)
+    if not records:
+        print('No stats recorded in %s' % stats_file)
+        return
+    times = package_times(records)
+    graph = dependency_graph(list(times), lookup)
+    total = sum(t['wall'] for t in times.values())
+    start = min(t['start'] for t in times.values())
+    end   = max(t['end']   for t in times.values())
+    length, path = critical_path(times, graph)
+
+    print('Build run %s: %d packages, %s elapsed, %s of package time' %
+          (run, len(times), _fmt(end - start), _fmt(total)))
+
+    print('\nPackages by time:')
+    print('%-20s %9s %6s  %s' % ('package', 'time', 'share', 'stages'))
+    for name, t in sorted(times.items(), key=lambda item: -item[1]['wall']):
+        stages = ' '.join('%s=%s' % (s, _fmt(w)) for s, w in t['stages'].items())
+        print('%-20s %9s %5.1f%%  %s%s' % (name, _fmt(t['wall']), 100. * t['wall'] / max(total, 1e-9),
+                                         stages, '' if t['ok'] else '  (failed)'))
+
+    counted = [t for t in times.values() if t['cc_hits'] is not None]
+    if counted:
+        print('\nCompiler cache:')
+        print('%-20s %8s %8s %6s' % ('package', 'hits', 'misses', 'rate'))
+        hits = misses = 0
+        for name, t in sorted(times.items(), key=lambda item: -(item[1]['cc_misses'] or 0)):
+            if t['cc_hits'] is None:
+                continue
+            hits   += t['cc_hits']
+            misses += t['cc_misses']
+            print('%-20s %8d %8d %5.1f%%' % (name, t['cc_hits'], t['cc_misses'],
+                                             100. * t['cc_hits'] / max(t['cc_hits'] + t['cc_misses'], 1)))
+        print('%-20s %8d %8d %5.1f%%' % ('total', hits, misses, 100. * hits / max(hits + misses, 1)))
+
+    retried = [(name, t) for name, t in times.items() if t['retries']]
+    if retried:
+        print('\nRetried after failing to reach a server:')
+        for name, t in sorted(retried, key=lambda item: -item[1]['retry_wait']):
+            print('  %-20s %3d retries, waited %s' % (name, t['retries'], _fmt(t['retry_wait'])))
+
+    print('\nCritical path (%s, %.1f%% of package time):' % (_fmt(length), 100. * length / max(total, 1e-9)))
+    for name in path:
+        print('  %-20s %9s' % (name, _fmt(times[name]['wall'])))
+
+    print('\nEstimated build time with N packages at once:')
+    serial = simulate(times, graph, 1)
+    for n in slots:
+        t = simulate(times, graph, n)
+        print('  N=%-3d %9s  speedup %5.2fx' % (n, _fmt(t), serial / max(t, 1e-9)))
+    print('  No build can take less than the critical path, %s (%.2fx)' %
+          (_fmt(length), serial / max(length, 1e-9)))
+
+    if trace_file is not None:
+        with open(trace_file, 'w') as f:
+            json.dump(chrome_trace(records), f)
+        print('\nWrote Chrome trace to %s' % trace_file)
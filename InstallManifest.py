@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+
+'''
+Manifests of the files each package installed, kept by build.py in
+<install-dir>/.binarybuilder-manifests/<package>.json.
+
+A manifest is made by comparing a stat snapshot of the install dir taken
+before the package configures (some packages install while they compile)
+with one taken after it installs, so only the files which appeared or
+changed get read, to hash them and tell what kind of file they are.
+The manifests say which package a file came from, which files to take
+out to uninstall a package, and what kind each file is, so make-dist
+doesn't need to look at them again.
+'''
+
+from __future__ import with_statement, print_function
+
+import json
+import os
+import os.path as P
+import tempfile
+import threading
+import time
+
+from BinaryDist import hash_file, file_kind, mkdir_f
+
+MANIFEST_DIR = '.binarybuilder-manifests'
+
+# Taken while a package installs, so that when several packages are built
+# at the same time, the files of each can be told apart.
+install_lock = threading.Lock()
+
+def snapshot(install_dir):
+    '''Map each file and symlink under install_dir to its size, mtime,
+       inode and mode'''
+    state = {}
+    for dirname, dirs, files in os.walk(install_dir):
+        if dirname == install_dir and MANIFEST_DIR in dirs:
+            dirs.remove(MANIFEST_DIR)
+        names = files + [d for d in dirs if P.islink(P.join(dirname, d))]
+        for name in names:
+            path = P.join(dirname, name)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            mtime = getattr(st, 'st_mtime_ns', None)
+            if mtime is None:
+                mtime = int(st.st_mtime * 1e9)
+            state[P.relpath(path, install_dir)] = (st.st_size, mtime, st.st_ino, st.st_mode)
+    return state
+
+def manifest_path(install_dir, pkgname):
+    return P.join(install_dir, MANIFEST_DIR, pkgname + '.json')
+
+class InstallManifest(object):
+    '''The files a package installed, each with its size, sha1, mode and
+       kind (see BinaryDist.file_kind), or the target of a symlink.'''
+
+    def __init__(self, pkgname, install_dir, files=None):
+        self.pkgname     = pkgname
+        self.install_dir = install_dir
+        self.files = files if files is not None else {}
+
+    @staticmethod
+    def entry(install_dir, name, st):
+        '''The manifest entry of the file called name, whose stat
+           snapshot is st'''
+        path = P.join(install_dir, name)
+        size, mtime, ino, mode = st
+        if P.islink(path):
+            return dict(kind='symlink', target=os.readlink(path), mtime=mtime, mode=mode)
+        return dict(kind=file_kind(path), size=size, mtime=mtime, mode=mode,
+                    sha1=hash_file(path))
+
+    @classmethod
+    def changed(cls, pkgname, install_dir, before, after):
+        '''The names of the files which changed in install_dir from the
+           snapshot before to the snapshot after. Files which are now as
+           the manifest of another package has them are left out: that
+           package installed them in the meantime, while this one was
+           being configured or compiled.'''
+        others = set()
+        for manifest in cls.load_all(install_dir):
+            if manifest.pkgname == pkgname:
+                continue
+            for name, entry in manifest.files.items():
+                st = after.get(name)
+                if st is not None and entry.get('mtime') == st[1] and \
+                       entry.get('size', st[0]) == st[0]:
+                    others.add(name)
+        return [name for name, st in after.items()
+                if before.get(name) != st and name not in others]
+
+    @classmethod
+    def record(cls, pkgname, install_dir, before, after, changed=None):
+        '''The manifest of the files which changed in install_dir from the
+           snapshot before to the snapshot after, as changed() tells, unless
+           they are given. Files the package installed before, which are
+           still there as they were, are kept in it too: an install may skip
+           copying the files which are up to date.'''
+        if changed is None:
+            changed = cls.changed(pkgname, install_dir, before, after)
+        files = {}
+        old = cls.load(install_dir, pkgname)
+        if old is not None:
+            for name, entry in old.files.items():
+                st = after.get(name)
+                if st is not None and before.get(name) == st and \
+                       entry.get('size', st[0]) == st[0]:
+                    files[name] = entry
+        for name in changed:
+            try:
+                files[name] = cls.entry(install_dir, name, after[name])
+            except (IOError, OSError):
+                pass # Gone since the snapshot
+        return cls(pkgname, install_dir, files)
+
+    @classmethod
+    def load(cls, install_dir, pkgname):
+        '''The manifest of a package, or None if it has none'''
+        try:
+            with open(manifest_path(install_dir, pkgname)) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        return cls(data['package'], install_dir, data['files'])
+
+    @classmethod
+    def load_all(cls, install_dir):
+        '''The manifests of all the packages installed in install_dir'''
+        manifests = []
+        dirname = P.join(install_dir, MANIFEST_DIR)
+        if not P.isdir(dirname):
+            return manifests
+        for name in sorted(os.listdir(dirname)):
+            if name.endswith('.json'):
+                manifest = cls.load(install_dir, name[:-len('.json')])
+                if manifest is not None:
+                    manifests.append(manifest)
+        return manifests
+
+    def save(self):
+        path = manifest_path(self.install_dir, self.pkgname)
+        mkdir_f(P.dirname(path))
+        fd, tmp = tempfile.mkstemp(dir=P.dirname(path), prefix='.tmp-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(dict(package=self.pkgname, install_dir=self.install_dir,
+                           time=time.time(), files=self.files), f, indent=1, sort_keys=True)
+        os.rename(tmp, path)
+
+    def existing(self):
+        '''The names of the files in the manifest which are still there'''
+        return sorted(name for name in self.files
+                      if P.lexists(P.join(self.install_dir, name)))
+
+    def unchanged(self, name):
+        '''Whether the file called name is still the one the package
+           installed'''
+        entry = self.files[name]
+        path  = P.join(self.install_dir, name)
+        try:
+            if entry['kind'] == 'symlink':
+                return P.islink(path) and os.readlink(path) == entry['target']
+            return not P.islink(path) and os.path.getsize(path) == entry['size'] and \
+                   hash_file(path) == entry['sha1']
+        except (IOError, OSError):
+            return False
+
+    def uninstall(self):
+        '''Delete the files the package installed, and then the directories
+           left empty, and the manifest. Files another package installed
+           too, or which changed since, are kept. Returns the names of the
+           files removed and of those kept.'''
+        others = set()
+        for manifest in self.load_all(self.install_dir):
+            if manifest.pkgname != self.pkgname:
+                others.update(manifest.files)
+        removed = []
+        kept = []
+        dirs = set()
+        for name in sorted(self.files):
+            path = P.join(self.install_dir, name)
+            if not P.lexists(path):
+                continue
+            if name in others or not self.unchanged(name):
+                kept.append(name)
+                continue
+            os.remove(path)
+            removed.append(name)
+            dirname = P.dirname(name)
+            while dirname:
+                dirs.add(dirname)
+                dirname = P.dirname(dirname)
+        # The deepest first, so their parents can go too once empty
+        for dirname in sorted(dirs, key=lambda d: -d.count(os.sep)):
+            try:
+                os.rmdir(P.join(self.install_dir, dirname))
+            except OSError:
+                pass # Not empty
+        try:
+            os.remove(manifest_path(self.install_dir, self.pkgname))
+        except OSError:
+            pass
+        return removed, kept
+
+def installed_kinds(install_dir):
+    '''Map the path of each file the manifests in install_dir list, which
+       is still the size it was installed with, to its kind'''
+    kinds = {}
+    for manifest in InstallManifest.load_all(install_dir):
+        for name, entry in manifest.files.items():
+            path = P.join(install_dir, name)
+            try:
+                if entry['kind'] != 'symlink' and os.lstat(path).st_size != entry['size']:
+                    continue
+            except OSError:
+                continue
+            kinds[path] = entry['kind']
+    return kinds
+
+class installing(object):
+    '''Records what puts the files of a package into its INSTALL_DIR:
+       installing it, which some packages do already while they compile,
+       or restoring it from the artifact cache. The snapshot of INSTALL_DIR
+       to compare with is taken when it is made, unless one taken earlier
+       is given. Enter it around the last stage which installs, so only
+       one package at a time is there, and call finish() once the files
+       are in to write the manifest of the package. The files are looked
+       at once: the first of changed(), install_bytes() or finish() to be
+       called takes the snapshot they are compared with.'''
+
+    def __init__(self, pkg, before=None):
+        self.pkg = pkg
+        self.install_dir = pkg.env['INSTALL_DIR']
+        self.before = before if before is not None else snapshot(self.install_dir)
+        self.after  = None
+        self._changed = None
+        self.manifest = None
+
+    def __enter__(self):
+        install_lock.acquire()
+        return self
+
+    def changed(self):
+        '''The names of the files the package installed, from a snapshot
+           taken the first time it is asked for'''
+        if self._changed is None:
+            self.after = snapshot(self.install_dir)
+            self._changed = InstallManifest.changed(self.pkg.pkgname, self.install_dir,
+                                                    self.before, self.after)
+        return self._changed
+
+    def install_bytes(self):
+        '''How much the files the package installed added to INSTALL_DIR'''
+        return sum(self.after[name][0] - self.before.get(name, (0,))[0]
+                   for name in self.changed())
+
+    def finish(self):
+        changed = self.changed()
+        self.manifest = InstallManifest.record(self.pkg.pkgname, self.install_dir,
+                                               self.before, self.after, changed)
+        self.manifest.save()
+        return self.manifest
+
+    def __exit__(self, exc_type, exc, tb):
+        install_lock.release()
@@ -8,7 +8,7 @@ from glob import glob
 import subprocess
 from BinaryBuilder import CMakePackage, GITPackage, Package, stage, warn, \
      PackageError, HelperError, SVNPackage, Apps, write_vw_config, write_asp_config, \
-     replace_line_in_file, run, get, program_paths, get_platform, find_file, get_cores
+     replace_line_in_file, run, get, unpack_archive, program_paths, get_platform, find_file, get_cores, break_link
 from BinaryDist import lib_ext, which
 
 class ccache(Package):
@@ -26,14 +26,17 @@ class m4(Package):
 class libtool(Package):
     src     = 'http://ftpmirror.gnu.org/libtool/libtool-2.4.2.tar.gz'
     chksum  = '22b71a8b5ce3ad86e1094e7285981cae10e6ff88'
+    deps    = ['m4']
 
 class autoconf(Package):
     src='http://ftp.gnu.org/gnu/autoconf/autoconf-2.69.tar.gz'
     chksum  = '562471cbcb0dd0fa42a76665acf0dbb68479b78a'
+    deps    = ['m4']
 
 class automake(Package):
     src='ftp://ftp.gnu.org/gnu/automake/automake-1.14.1.tar.gz'
     chksum  = '0bb1714b78d70cab9907d2013082978a28f48a46'
+    deps    = ['autoconf']
 
 class cmake(Package):
     src     = 'https://github.com/Kitware/CMake/releases/download/v3.14.5/cmake-3.14.5.tar.gz'
@@ -54,7 +57,9 @@ class cmake(Package):
         super(cmake, self).configure(other = opts)
 
     def compile(self):
-        cmd = ['gmake',  '-j%d' % get_cores() ]
+        cmd = ['gmake']
+        if 'MAKEOPTS' in self.env:
+            cmd += self.env['MAKEOPTS'].split(' ')
         self.helper(*cmd)
 
     # cmake pollutes the doc folder
@@ -101,6 +106,7 @@ class bzip2(Package):
 class pbzip2(Package):
     src     = 'https://launchpad.net/pbzip2/1.1/1.1.6/+download/pbzip2-1.1.6.tar.gz'
     chksum  = '46cbdcf95b06e72be576d3bd12643de4aa27af5f'
+    deps    = ['bzip2']
 
     def configure(self): pass
     def compile(self):
@@ -194,6 +200,7 @@ class openjpeg2(CMakePackage):
 class tiff(Package):
     src     = 'http://download.osgeo.org/libtiff/tiff-4.0.8.tar.gz'
     chksum  = '88717c97480a7976c94d23b6d9ed4ac74715267f'
+    deps    = ['zlib', 'jpeg', 'png']
 
     def configure(self):
         super(tiff, self).configure(
@@ -205,6 +212,7 @@ class tiff(Package):
 class libgeotiff(CMakePackage):
     src='http://download.osgeo.org/geotiff/libgeotiff/libgeotiff-1.4.0.tar.gz'
     chksum='4c6f405869826bb7d9f35f1d69167e3b44a57ef0'
+    deps = ['tiff', 'proj']
     def configure(self):
         super(libgeotiff, self).configure( other=[
             '-DCMAKE_CXX_FLAGS=-O3',
@@ -217,6 +225,8 @@ class gdal(Package):
     src     = 'http://download.osgeo.org/gdal/2.0.2/gdal202.zip'
     chksum  = '91c1ce0e5156ab0e2671ae9133324e52f12c73b8'
     patches = 'patches/gdal'
+    deps    = ['autoconf', 'automake', 'libtool', 'zlib', 'png', 'jpeg', 'tiff',
+               'libgeotiff', 'proj', 'geos', 'openjpeg2', 'curl']
 
     @stage
     def configure(self):
@@ -263,6 +273,7 @@ class ilmbase(Package):
     src     = 'http://download.savannah.nongnu.org/releases/openexr/ilmbase-1.0.2.tar.gz'
     chksum  = 'fe6a910a90cde80137153e25e175e2b211beda36'
     patches = 'patches/ilmbase'
+    deps    = ['autoconf', 'automake', 'libtool']
 
     @stage
     def configure(self):
@@ -277,6 +288,7 @@ class openexr(Package):
     src     = 'http://download.savannah.nongnu.org/releases/openexr/openexr-1.7.0.tar.gz'
     chksum  = '91d0d4e69f06de956ec7e0710fc58ec0d4c4dc2b'
     patches = 'patches/openexr'
+    deps    = ['autoconf', 'automake', 'libtool', 'ilmbase', 'zlib']
 
     @stage
     def configure(self):
@@ -344,6 +356,7 @@ class proj(Package):
 class openssl(Package):
     src = 'https://github.com/openssl/openssl/archive/OpenSSL_1_1_0e.tar.gz'
     chksum = '14eaed8edc7e48fe1f01924fa4561c1865c9c8ac'
+    deps = ['zlib']
 
     @stage
     def configure(self):
@@ -357,6 +370,7 @@ class openssl(Package):
 class curl(Package):
     src     = 'http://curl.haxx.se/download/curl-7.57.0.tar.bz2'
     chksum  = '7f47469324bf22cc9ffd1d3a201aa3c76ab626b8'
+    deps    = ['zlib', 'openssl']
 
     @stage
     def configure(self):
@@ -369,6 +383,7 @@ class liblas(GITPackage, CMakePackage):
     src     = 'git@github.com:oleg-alexandrov/libLAS.git'
     #chksum  = 'e30c1efb3df4bcdc7119d7c42638e7a01b14f236'
     #patches = 'patches/liblas'
+    deps    = ['boost', 'tiff', 'libgeotiff', 'gdal', 'laszip']
 
     @stage
     def configure(self):
@@ -460,6 +475,7 @@ class laszip(CMakePackage):
 
 class libelas(GITPackage, CMakePackage):
     src = 'git@github.com:NeoGeographyToolkit/libelas.git'
+    deps = ['tiff']
 
     @stage
     def configure(self):
@@ -515,6 +531,7 @@ class hdf5(Package):
     # from Minconda's directory.
     src     = 'https://support.hdfgroup.org/ftp/HDF5/releases/hdf5-1.8/hdf5-1.8.18/src/hdf5-1.8.18.tar.bz2'
     chksum  = 'd7e008cbfcf5cb6913b5327a81bbcaf34cc9436d'
+    deps    = ['zlib']
     def configure(self):
         super(hdf5, self).configure(enable=('cxx'), disable = ['static'])
 
@@ -624,6 +641,11 @@ class usgscsm(GITPackage, CMakePackage):
 
 class stereopipeline(GITPackage, CMakePackage):
     src     = 'https://github.com/NeoGeographyToolkit/StereoPipeline.git'
+    deps    = ['visionworkbench', 'isis', 'usgscsm', 'libelas', 'geoid', 'gsl',
+               'xercesc', 'protobuf', 'superlu', 'gmm', 'qt', 'qwt', 'suitesparse',
+               'tnt', 'jama', 'laszip', 'liblas', 'fgr', 'bullet', 'embree',
+               'nanoflann', 'nn', 'pcl', 'armadillo', 'gflags', 'glog', 'ceres',
+               'libnabo', 'libpointmatcher', 'imagemagick', 'theia', 'htdp', 'parallel']
     def configure(self):
 
         ## Skip config in fast mode if config file exists
@@ -675,10 +697,7 @@ class stereopipeline(GITPackage, CMakePackage):
         if self.fast or int(self.env['SKIP_TESTS']) == 1:
             print("Skipping tests.")
         else:
-            cmd = ('make', 'gtest_all')
-            # TODO(oalexan1): Replace buildDir below with self.builddir?
-            buildDir = os.path.join(self.workdir, 'build_binarybuilder')
-            self.helper(*cmd, cwd=buildDir)
+            self.cmake_build('gtest_all')
 
     @stage
     def install(self):
@@ -686,6 +705,9 @@ class stereopipeline(GITPackage, CMakePackage):
 
 class visionworkbench(GITPackage, CMakePackage):
     src = 'https://github.com/visionworkbench/visionworkbench.git'
+    deps = ['zlib', 'openssl', 'curl', 'png', 'jpeg', 'tiff', 'proj', 'openjpeg2',
+            'libgeotiff', 'geos', 'gdal', 'ilmbase', 'openexr', 'boost', 'flann',
+            'hdf5', 'eigen', 'opencv']
 
     def __init__(self,env):
         super(visionworkbench,self).__init__(env)
@@ -727,9 +749,7 @@ class visionworkbench(GITPackage, CMakePackage):
         if self.fast or int(self.env['SKIP_TESTS']) == 1:
             print("Skipping tests.")
         else:
-            cmd = ('make', 'gtest_all')
-            buildDir = os.path.join(self.workdir, 'build_binarybuilder')
-            self.helper(*cmd, cwd=buildDir)
+            self.cmake_build('gtest_all')
 
     @stage
     def install(self):
@@ -753,8 +773,14 @@ class lapack(CMakePackage):
 class boost(Package):
     version = '1_67' # variable is used in class liblas, libnabo, etc.
     src     = 'http://downloads.sourceforge.net/boost/boost_' + version + '_0.tar.bz2'
+    mirrors = ['https://archives.boost.io/release/' + version.replace('_', '.') + '.0/source/boost_' + version + '_0.tar.bz2']
     chksum  = '694ae3f4f899d1a80eb7a3b31b33be73c423c1ae'
     patches = 'patches/boost'
+    # Never built, and a good part of the tarball. The tests of the
+    # libraries must stay: the feature checks of the build, like those
+    # of libs/config/checks, compile code from them.
+    unpack_exclude = ['doc/*', 'libs/*/doc/*', 'libs/*/example/*']
+    deps    = ['zlib']
 
     def __init__(self, env):
         super(boost, self).__init__(env)
@@ -765,7 +791,9 @@ class boost(Package):
 
     @stage
     def configure(self):
-        with open(P.join(self.workdir, 'user-config.jam'), 'w') as f:
+        config = P.join(self.workdir, 'user-config.jam')
+        break_link(config)
+        with open(config, 'w') as f:
             if self.arch.os == 'linux':
                 toolkit = 'gcc'
             elif self.arch.os == 'osx':
@@ -834,6 +862,7 @@ class superlu(Package):
     # TODO: This may need some tweaks.
     src    = ['http://sources.gentoo.org/cgi-bin/viewvc.cgi/gentoo-x86/sci-libs/superlu/files/superlu-4.3-autotools.patch','http://crd-legacy.lbl.gov/~xiaoye/SuperLU/superlu_4.3.tar.gz']
     chksum = ['c9cc1c9a7aceef81530c73eab7f599d652c1fddd','d2863610d8c545d250ffd020b8e74dc667d7cbdd']
+    deps = ['autoconf', 'automake', 'libtool']
 
     def __init__(self,env):
         super(superlu,self).__init__(env)
@@ -896,6 +925,7 @@ class gmm(Package):
     src     = 'http://download-mirror.savannah.gnu.org/releases/getfem/stable/gmm-4.2.tar.gz'
     chksum  = '3555d5a5abdd525fe6b86db33428604d74f6747c'
     patches = 'patches/gmm'
+    deps    = ['autoconf', 'automake', 'libtool', 'lapack']
 
     @stage
     def configure(self):
@@ -910,6 +940,7 @@ class gmm(Package):
 class xercesc(Package):
     src    = 'http://archive.apache.org/dist/xerces/c/3/sources/xerces-c-3.1.3.tar.xz'
     chksum = '44aa39f8b9ccbfcaf58771634761cbea1084e8f1'
+    deps = ['curl']
 
     @stage
     def configure(self):
@@ -921,6 +952,14 @@ class qt(Package):
     src     = 'http://download.qt.io/official_releases/qt/5.6/5.6.3/single/qt-everywhere-opensource-src-5.6.3.tar.xz'
     chksum  = 'ca7a752bff079337876ca6ab70b0dec17b47e70f' #SHA-1 Hash
     patches = 'patches/qt'
+    # The modules we -skip below (configure wants their directories to
+    # be there, but not what is in them), and the examples of each module,
+    # which -nomake examples leaves out.
+    unpack_exclude = [m + '/*' for m in (
+        'qt3d', 'qtactiveqt', 'qtandroidextras', 'qtconnectivity', 'qtlocation',
+        'qtmacextras', 'qtquickcontrols', 'qtquickcontrols2', 'qtsensors',
+        'qtserialbus', 'qtserialport', 'qtwayland', 'qtwebchannel', 'qtwebengine',
+        'qtwebview', 'qtwinextras')] + ['qt*/examples/*']
     #patch_level = '-p0'
 
     @stage
@@ -982,6 +1021,7 @@ class qwt(Package):
     src     = 'http://downloads.sourceforge.net/qwt/qwt-6.1.3.tar.bz2',
     chksum  = '90ec21bc42f7fae270482e1a0df3bc79cb10e5c7',
     patches = 'patches/qwt'
+    deps    = ['qt']
 
     def configure(self):
 
@@ -1015,6 +1055,7 @@ class qwt(Package):
 
 class zlib(Package):
     src     = 'http://downloads.sourceforge.net/libpng/zlib-1.2.8.tar.gz'
+    mirrors = ['https://zlib.net/fossils/zlib-1.2.8.tar.gz']
     chksum  = 'a4d316c404ff54ca545ea71a27af7dbc29817088'
 
     @stage
@@ -1038,6 +1079,7 @@ class jpeg(Package):
 class png(Package):
     src    = 'http://downloads.sourceforge.net/libpng/libpng-1.6.37.tar.gz'
     chksum = 'bdd5a59136c6b1e4cc94de12268122796e24036a'  # fix here
+    deps = ['zlib']
 
     def configure(self):
         super(png,self).configure(disable='static', 
@@ -1144,6 +1186,7 @@ class dsk(Package):
 class protobuf(Package):
     src = 'https://github.com/google/protobuf/releases/download/v2.6.1/protobuf-2.6.1.tar.bz2'
     chksum = '6421ee86d8fb4e39f21f56991daa892a3e8d314b'
+    deps = ['autoconf', 'automake', 'libtool']
     @stage
     def configure(self):
         
@@ -1207,6 +1250,7 @@ class osg3(CMakePackage):
     src = 'https://github.com/openscenegraph/OpenSceneGraph/archive/OpenSceneGraph-3.2.0.zip'
     chksum = '5435de08cd7f67691f6be7cfa0d36b80f04bcb34'
     patches = 'patches/osg3'
+    deps    = ['zlib', 'png', 'jpeg', 'openexr', 'gdal']
 
     def configure(self):
         other_flags = [
@@ -1263,6 +1307,7 @@ class flann(GITPackage, CMakePackage):
 class eigen(CMakePackage):
     src = 'http://bitbucket.org/eigen/eigen/get/3.2.5.tar.bz2'
     chksum = 'aa4667f0b134f5688c5dff5f03335d9a19aa9b3d'
+    deps = ['boost']
 
     def configure(self):
         super(eigen, self).configure(other=[
@@ -1274,6 +1319,7 @@ class eigen(CMakePackage):
 class glog(CMakePackage):
     src     = 'https://github.com/google/glog/archive/v0.3.5.tar.gz'
     chksum  = '61067502c5f9769d111ea1ee3f74e6ddf0a5f9cc'
+    deps    = ['gflags']
 
     def configure(self):
         ext = lib_ext(self.arch.os)
@@ -1296,6 +1342,7 @@ class glog(CMakePackage):
 class ceres(CMakePackage):
     src = 'http://ceres-solver.org/ceres-solver-1.14.0.tar.gz'
     chksum = '57b61c28d67ca3eb814c5605120ae614be465b7c'
+    deps = ['eigen', 'gflags', 'glog', 'suitesparse']
 
     def configure(self):
         ext = lib_ext(self.arch.os)
@@ -1327,6 +1374,7 @@ class libnabo(GITPackage, CMakePackage):
     src = 'git@github.com:oleg-alexandrov/libnabo.git'
     #patches = 'patches/libnabo' # no patches
     #chksum = '2df86e0' # use latest version
+    deps    = ['boost', 'eigen']
 
     def configure(self):
 
@@ -1362,6 +1410,7 @@ class libnabo(GITPackage, CMakePackage):
 class libpointmatcher(GITPackage, CMakePackage):
     src   = 'https://github.com/oleg-alexandrov/libpointmatcher.git'
     # chksum = 'bcf4b04' # no checksum; use latest
+    deps    = ['boost', 'eigen', 'libnabo']
 
     def configure(self):
         installDir = self.env['INSTALL_DIR']
@@ -1420,6 +1469,7 @@ class libpointmatcher(GITPackage, CMakePackage):
 class fgr(GITPackage, CMakePackage):
     src   = 'git@github.com:oleg-alexandrov/FastGlobalRegistration.git'
     # chksum = 'bfcb9f9' # comment this out, use the latest version
+    deps    = ['eigen', 'flann']
 
     @stage
     def configure(self):
@@ -1453,6 +1503,7 @@ class fgr(GITPackage, CMakePackage):
 # in the nightly builds and regressions.
 class binarybuilder(GITPackage):
     src     = 'https://github.com/NeoGeographyToolkit/BinaryBuilder.git'
+    cacheable = False
     def configure(self): pass
 
     @stage
@@ -1469,6 +1520,11 @@ class opencv(CMakePackage):
         src     = 'https://github.com/opencv/opencv/archive/3.1.0.tar.gz'
         chksum  = '31dd36c5d59c76f6b7982a64d6ffc0993736d7ea'
     #patches = 'patches/opencv'
+    deps    = ['zlib', 'jpeg', 'png', 'tiff', 'eigen']
+    # CMake adds the samples and the test and perf directories of the
+    # modules only with BUILD_EXAMPLES, BUILD_TESTS and BUILD_PERF_TESTS,
+    # which are off below (doc/ must stay, CMake always adds it)
+    unpack_exclude = ['samples/*', 'modules/*/test/*', 'modules/*/perf/*']
 
     # NOTE: OSX 10.12 seems to require a newer version (3.3.1 works) but that does not work on CentOS 6.
     #  - To get it to build on CentOS 6, a newer CMake is needed (with SSL/HTTPS support) to perform
@@ -1588,6 +1644,7 @@ class gflags(CMakePackage):
 class imagemagick(Package):
     src     = 'http://downloads.sourceforge.net/project/imagemagick/old-sources/6.x/6.8/ImageMagick-6.8.6-10.tar.gz'
     chksum  = '6ea9dfc1042bb2057f8aa08e81e18c0c83451109'
+    deps    = ['zlib', 'jpeg', 'png']
 
     def __init__(self, env):
         super(imagemagick, self).__init__(env)
@@ -1606,6 +1663,7 @@ class imagemagick(Package):
 class theia(GITPackage, CMakePackage):
     src     = 'git@github.com:oleg-alexandrov/TheiaSfM.git'
     chksum  = 'f5d93f5'
+    deps    = ['eigen', 'flann', 'gflags', 'glog', 'ceres']
 
     @stage
     def configure(self):
@@ -1658,11 +1716,10 @@ class bullet(CMakePackage):
         curr_include = '-I' + self.workdir + '/src'
         self.env['CPPFLAGS'] = curr_include + ' ' + self.env['CPPFLAGS']
 
-        self.env['MAKEOPTS'] += ''' CFLAGS="-fPIC"''' # Needed for ISIS
-        
         # Turn off extra stuff
         options = ['-DCMAKE_CXX_FLAGS=-fPIC',
-                   '-DCMAKE_C_FLAGS=-O3',
+                   '-DCMAKE_C_FLAGS=-O3 -fPIC', # Needed for ISIS
+                   '-DCMAKE_POSITION_INDEPENDENT_CODE=ON',
                    '-DBUILD_CPU_DEMOS=OFF',
                    '-DBUILD_OPENGL3_DEMOS=OFF',
                    '-DBUILD_BULLET2_DEMOS=OFF',
@@ -1718,6 +1775,7 @@ class nn(GITPackage):
 class pcl(CMakePackage):
     src    = 'https://github.com/PointCloudLibrary/pcl/archive/pcl-1.8.1.tar.gz'
     chksum = '6813478c27566da3eb5835b384524fd775115465'
+    deps = ['boost', 'eigen', 'flann']
     
     @stage
     def configure(self):
@@ -1760,8 +1818,7 @@ class htdp(Package):
         output_dir = P.join(self.env['BUILD_DIR'], self.pkgname)
 
         self.remove_build(output_dir) # Throw out the old content
-        os.system('mkdir -p ' + output_dir)
-        self.helper('unzip', '-d', output_dir, self.tarball)     
+        unpack_archive(self.tarball, output_dir)
         self.workdir = output_dir
             
     @stage
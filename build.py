@@ -15,6 +15,9 @@ import errno
 import string
 import types
 import time
+import threading
+import atexit
+import json
 from optparse import OptionParser
 from tempfile import mkdtemp
 from distutils import version
@@ -22,10 +25,17 @@ from glob import glob
 
 from BinaryBuilder import Package, Environment, PackageError, die, info,\
      get_platform, find_file, run, logger, warn, \
-     program_exists, get_cores
-
+     program_exists, get_cores, run_graph, run_pool, JobServer, set_jobserver, \
+     CompilerCache, set_compiler_cache, PackageRegistry, remote_head, STAGES, \
+     RetryPolicy, set_retry_policy
+
+from BinaryCache import ArtifactCache, cache_backend
+from BuildReport import report
+from BuildLog import show_errors
+from InstallManifest import InstallManifest
 from BinaryDist import fix_install_paths, which, binary_builder_prefix, get_prog_version
 
+import Packages
 from Packages import *
 
 CC_FLAGS = ('CFLAGS', 'CXXFLAGS')
@@ -66,11 +76,17 @@ def is_sequence(arg):
             hasattr(arg, "__iter__"))
 
 def get_chksum(name):
-    try:
-        pkg = globals()[name](build_env)
-    except KeyError:
+    meta = registry.info(name)
+    if meta is None:
         return "none"
-    chksum = pkg.chksum
+    chksum = meta.chksum
+    if chksum is None and 'GITPackage' in meta.kind:
+        # The latest commit, as the package itself would find it
+        env = dict(build_env)
+        env['LD_LIBRARY_PATH'] = ''
+        chksum = remote_head(meta.src, env,
+                             P.join(build_env['DOWNLOAD_DIR'], 'git', 'heads.json'),
+                             int(build_env.get('GIT_HEADS_TTL', 0)))
 
     if isinstance(chksum, int):
         # Convert an integer to a string
@@ -116,23 +132,44 @@ if __name__ == '__main__':
 
     parser.add_option('--base',       action='append',      dest='base',         default=[],              help='Provide a tarball to use as a base system')
     parser.add_option('--build-root',                       dest='build_root',   default='./build_asp',            help='Root of the build and install')
+    parser.add_option('--cache-dir',                        dest='cache_dir',    default='./cache',       help='Where to keep the files installed by each package, to reuse them in later builds')
+    parser.add_option('--source-cache', action='store_true', dest='source_cache', default=False,       help='Keep the patched sources of each package in <cache-dir>/sources, and copy them from there rather than unpacking and patching them again')
     parser.add_option('--cc',                               dest='cc',           default='',           help='Explicitly state which C compiler to use. Default: gcc on Linux and clang on OSX.')
     parser.add_option('--cxx',                              dest='cxx',          default='',           help='Explicitly state which C++ compiler to use. Default: g++ on Linux and clang++ on OSX.')
     parser.add_option('--build-goal', type='int',           dest='build_goal',   default=BUILD_GOAL_ASP,  help='Select the goal of the build.  Increasing numbers are smaller builds: [0 = Full ASP build, 1 = Prerequisites for ASP/VW development build, 2 = VW build, 3 = Prerequisites for VW build]')
     parser.add_option('--asp-deps-dir',                   dest='asp_deps_dir', default='', help='Path to where conda installed the ASP dependencies. Default: $HOME/miniconda3/envs/asp_deps.')
     parser.add_option('--isis-dir',                        dest='isis_dir', default='', help='Path to where ISIS 3 was checked out and built (it has subdirectories named isis, build, and install).')
     parser.add_option('--download-dir',                     dest='download_dir', default='./tarballs', help='Where to archive source files')
+    parser.add_option('--fetch-jobs', type='int',           dest='fetch_jobs',   default=8,               help='How many sources to fetch at the same time with --fetch')
+    parser.add_option('--fetch-per-host', type='int',       dest='fetch_per_host', default=3,             help='How many sources to fetch at the same time from the same server with --fetch')
     parser.add_option('--gfortran',                              dest='gfortran',          default='gfortran',      help='Explicitly state which Fortran compiler to use. [gfortran (default), gfortran-mp-4.7]')
     parser.add_option('--fetch',      action='store_const', dest='mode',         const='fetch',           help='Fetch sources only, don\'t build')
     parser.add_option('--libtoolize',                       dest='libtoolize',   default=None,            help='Value to set LIBTOOLIZE, use to override if system\'s default is bad.')
-    parser.add_option('--no-ccache',  action='store_false', dest='ccache',       default=True,            help='Disable ccache')
+    parser.add_option('--no-ccache',  action='store_false', dest='ccache',       default=True,            help='Do not compile through ccache or sccache')
+    parser.add_option('--ccache-dir',                       dest='ccache_dir',   default=P.join(os.environ.get('XDG_CACHE_HOME', P.expanduser('~/.cache')), 'binarybuilder', 'ccache'), help='The compiler cache, shared by all build roots')
+    parser.add_option('--ccache-size',                      dest='ccache_size',  default='20G',           help='Size limit of the compiler cache')
+    parser.add_option('--no-cache',   action='store_false', dest='cache',        default=True,            help='Build every package from source, do not save what they install to the cache, and do not share the results of configure checks between packages')
     parser.add_option('--no-fetch',   action='store_const', dest='mode',         const='nofetch',         help='Build, but do not fetch (will fail if sources are missing)')
     parser.add_option('--osx-sdk-version',                  dest='osx_sdk',      default='10.12',          help='SDK version to use. Make sure you have the SDK version before requesting it.')
     parser.add_option('--pretend',    action='store_true',  dest='pretend',      default=False,           help='Show the list of packages without actually doing anything')
-    parser.add_option('--resume',     action='store_true',  dest='resume',       default=False,           help='Reuse in-progress build/install dirs')
+    parser.add_option('--remote-cache',                     dest='remote_cache', default=None,            help='URL (or directory) of an artifact cache shared with other machines')
+    parser.add_option('--remote-cache-readonly', action='store_false', dest='cache_push', default=True,  help='Take artifacts from the shared cache, but do not send new ones to it')
+    parser.add_option('--console-logs', action='store_true', dest='console_logs', default=False,         help='Print the output of the build commands, rather than keeping it in <build-root>/logs')
+    parser.add_option('--show-errors',                      dest='show_errors',  default=None,            help='Show the errors in the logs of the last build of a package, and exit')
+    parser.add_option('--retries',    type='int',           dest='retries',      default=5,               help='How many times to try fetching sources, looking up git commits and checking out svn again after they fail, before giving up')
+    parser.add_option('--retry-delay', type='float',        dest='retry_delay',  default=10.0,            help='Seconds to wait before trying to fetch again, doubled after each failure, up to 5 minutes')
+    parser.add_option('--uninstall',  action='store_true',  dest='uninstall',    default=False,           help='Delete the files the packages given installed in the build root, rather than building them')
+    parser.add_option('--list',       action='store_true',  dest='list',         default=False,           help='List the packages given, or all of them, with their sources and dependencies, and exit')
+    parser.add_option('--json',       action='store_true',  dest='json',         default=False,           help='With --list, print the list as JSON')
+    parser.add_option('--report',     action='store_true',  dest='report',       default=False,           help='Show where the time of the last build in the build root went, and write a Chrome trace of it to <build-root>/trace.json')
+    parser.add_option('--resume',     action='store_true',  dest='resume',       default=False,           help='Reuse in-progress build/install dirs, and restart each package at the stage it failed')
     parser.add_option('--save-temps', action='store_true',  dest='save_temps',   default=False,           help='Save build files to check include paths')
     parser.add_option('--threads',    type='int',           dest='threads',      default=get_cores(),     help='Build threads to use')
+    parser.add_option('--jobs',       type='int',           dest='jobs',         default=1,               help='How many packages to build at the same time. Packages wait for the ones they depend on.')
+    parser.add_option('--no-jobserver', action='store_false', dest='jobserver', default=True,          help='Do not share the --threads build jobs among all packages through a make jobserver')
     parser.add_option('--skip-tests',  action='store_true', dest='skip_tests',   default=False,           help='Skip running tests when building VW and ASP. The latter is very time-consuming.')
+    parser.add_option('--git-heads-ttl', type='int',        dest='git_heads_ttl', default=0,              help='Remember the latest commit of each git package for this many seconds in <download-dir>/git/heads.json, rather than asking its server on every run')
+    parser.add_option('--git-clone',  type='choice', choices=['shared', 'worktree', 'partial', 'full'], dest='git_clone', default='shared', help='How git packages get their sources out of their mirror in <download-dir>/git: a clone sharing its objects (shared, the default), a worktree of it (worktree), a clone with only the files checked out (partial), or a full clone (full)')
     parser.add_option('--fast',                             action='store_true', dest='fast', default=False,           help='For any git package, update and build in existing directory rather than stating from scratch (may fail)')
     parser.add_option('--add-ld-library-path',              dest='ld_library_path', default=None,          help='This is a hack for the supercomputer that uses libstdc++ in a non-standard location. Please don\'t use this option unless you truly needed. This has the ability to corrupt our builds if you put /usr/lib or /lib as an argument.')
     parser.add_option('--add-library-path',              dest='library_path', default=None,          help='This is a hack for the supercomputer that uses libstdc++ in a non-standard location. Please don\'t use this option unless you truly needed. This has the ability to corrupt our builds if you put /usr/lib or /lib as an argument.')
@@ -140,6 +177,54 @@ if __name__ == '__main__':
     global opt
     (opt, args) = parser.parse_args()
 
+    set_retry_policy(RetryPolicy(attempts=opt.retries + 1, delay=opt.retry_delay))
+
+    # What there is to know about the packages without building them
+    registry = PackageRegistry(Packages, get_platform().osbits)
+
+    if opt.list:
+        names = args or list(registry)
+        unknown = [name for name in names if name not in registry]
+        if unknown:
+            die('Unknown packages: %s' % ' '.join(unknown))
+        infos = [registry.info(name) for name in names]
+        if opt.json:
+            print(json.dumps([meta._asdict() for meta in infos], indent=1))
+        else:
+            for meta in infos:
+                print('%-20s %-28s %s' % (meta.name, '+'.join(meta.kind), ' '.join(meta.deps)))
+        sys.exit(0)
+
+    if opt.show_errors is not None:
+        found = show_errors(P.join(opt.build_root, 'logs'), opt.show_errors, ('restore',) + STAGES)
+        sys.exit(1 if found else 0)
+
+    if opt.uninstall:
+        if opt.build_root is None:
+            die('--uninstall needs the --build-root the packages were built in')
+        unknown = [name for name in args if name not in registry]
+        if unknown:
+            die('Unknown packages: %s' % ' '.join(unknown))
+        install_dir = P.join(P.realpath(opt.build_root), 'install')
+        for name in args:
+            manifest = InstallManifest.load(install_dir, name)
+            if manifest is None:
+                print('No record of what %s installed in %s' % (name, install_dir))
+                continue
+            removed, kept = manifest.uninstall()
+            print('Removed %d files of %s' % (len(removed), name))
+            for f in kept:
+                print('  Kept %s, another package installed or changed it' % f)
+        sys.exit(0)
+
+    if opt.report:
+        stats_file = P.join(opt.build_root, 'stats.jsonl')
+        if not P.exists(stats_file):
+            die('Cannot find the stats of a build in: ' + stats_file)
+        report(stats_file, registry.get,
+               trace_file=P.join(opt.build_root, 'trace.json'))
+        sys.exit(0)
+
     info('Using %d build processes' % opt.threads)
 
     if opt.ccache and opt.save_temps:
@@ -162,6 +247,7 @@ if __name__ == '__main__':
     # Things misbehave if directories have symlinks or are relative
     opt.build_root = P.realpath(opt.build_root)
     opt.download_dir = P.realpath(opt.download_dir)
+    opt.cache_dir = P.realpath(opt.cache_dir)
 
     # We count in deploy-base.py on opt.build_root to contain the
     # string binary_builder_prefix()
@@ -240,9 +326,26 @@ if __name__ == '__main__':
         PATH = os.environ['PATH'],
         #LD_LIBRARY_PATH = os.environ['LD_LIBRARY_PATH'],
         FAST = str(int(opt.fast)),
+        GIT_CLONE = opt.git_clone,
+        GIT_HEADS_TTL = str(opt.git_heads_ttl),
         SKIP_TESTS = str(int(opt.skip_tests)),
+        # Time and resources used by each stage of each package
+        STATS_FILE = P.join(opt.build_root, 'stats.jsonl'),
+        STATS_RUN  = time.strftime('%Y-%m-%dT%H:%M:%S'),
         )
 
+    if opt.cache:
+        # Compiler checks shared by the configure scripts of all packages
+        build_env['AUTOCONF_CACHE_DIR'] = P.join(opt.cache_dir, 'autoconf')
+
+    if not opt.console_logs:
+        # The output of each stage of each package, see BuildLog.py
+        build_env['LOG_DIR'] = P.join(opt.build_root, 'logs')
+
+    if opt.source_cache:
+        # Patched sources of each package, copied into BUILD_DIR on unpack
+        build_env['SOURCE_CACHE_DIR'] = P.join(opt.cache_dir, 'sources')
+
     if opt.ld_library_path is not None:
         build_env['LD_LIBRARY_PATH'] = opt.ld_library_path
 
@@ -411,9 +514,12 @@ if __name__ == '__main__':
     # additional packages or minus packages.
     if len(args) != 0:
         # Seperate the packages out that have a minus
-        remove_build = [globals()[pkg[1:]] for pkg in args if pkg.startswith('_')]
+        unknown = [pkg for pkg in args if pkg.lstrip('_') not in registry]
+        if unknown:
+            die('Unknown packages: %s' % ' '.join(unknown))
+        remove_build = [registry.get(pkg[1:]) for pkg in args if pkg.startswith('_')]
         # Add the stuff without a minus in front of them
-        build.extend( [globals()[pkg] for pkg in args if not pkg.startswith('_')] )
+        build.extend( [registry.get(pkg) for pkg in args if not pkg.startswith('_')] )
         for pkg in remove_build:
             build.remove( pkg )
 
@@ -433,68 +539,118 @@ if __name__ == '__main__':
 
     # This must happen after untarring the base system,
     # as perhaps cache will be found there.
- #    if opt.ccache:
-
-#         try:
-#             ccache_path = find_file('ccache', build_env['PATH'])
-#         except:
-#             # If could not find ccache, build it.
-#             print("\n========== Building: %s ==========" % ccache.__name__)
-#             Package.build(ccache(build_env.copy_set_default()))
-#             ccache_path = find_file('ccache', build_env['PATH'])
-
-#         print(compiler_dir)
-#         new = dict(
-#             CC  = P.join(compiler_dir, os.path.basename(build_env['CC'])),
-#             CXX = P.join(compiler_dir, os.path.basename(build_env['CXX'])),
-#         )
-#         print(new)
-#         print(ccache_path)
-
-#         print(['ln', '-sf', ccache_path, new['CC']])
-#         subprocess.check_call(['ln', '-sf', ccache_path, new['CC']])
-#         subprocess.check_call(['ln', '-sf', ccache_path, new['CXX']])
-#         build_env.update(new)
+    if opt.ccache:
+        # Compile through ccache or sccache, with the compilers in the
+        # PATH replaced by wrappers
+        compiler_cache = CompilerCache.find(P.realpath(opt.ccache_dir), opt.ccache_size)
+        if compiler_cache is None:
+            print('Neither ccache nor sccache was found, compiling without a compiler cache')
+        else:
+            info('Using %s with the cache in %s' % (compiler_cache.name, compiler_cache.cache_dir))
+            compiler_cache.setup(build_env, compiler_dir)
+            set_compiler_cache(compiler_cache)
+
+    # Packages whose cache key is found in the artifact cache are not built,
+    # the files they installed last time are copied over instead.
+    cache = None
+    if opt.cache and opt.mode != 'fetch':
+        salt = ' '.join(run(build_env[c], '--version').split('\n')[0]
+                        for c in ('CC', 'CXX'))
+        remote = None
+        if opt.remote_cache is not None:
+            remote = cache_backend(opt.remote_cache)
+        cache = ArtifactCache(opt.cache_dir, salt=salt, remote=remote, push=opt.cache_push)
+    cache_keys = {}
+    cache_lock = threading.RLock()
+
+    def cache_key(pkg):
+        '''The artifact cache key of a package instance. It covers the keys of
+           all the packages it depends on, so rebuilding one of those
+           rebuilds it too.'''
+        name = pkg.pkgname
+        with cache_lock:
+            if name not in cache_keys:
+                cache_keys[name] = None # In case of circular dependencies
+                dep_keys = []
+                for dep in pkg.dependencies():
+                    if dep in cache_keys:
+                        dep_keys.append(cache_keys[dep])
+                    elif dep in registry:
+                        dep_keys.append(cache_key(registry.get(dep)(build_env)))
+                cache_keys[name] = cache.key(pkg, dep_keys)
+            return cache_keys[name]
+
+    def build_cached(pkg, skip_fetch):
+        key = None
+        if cache is not None:
+            key = cache_key(pkg)
+        Package.build(pkg, skip_fetch=skip_fetch, cache=cache, key=key, resume=opt.resume)
 
     modes = dict(
-        all     = lambda pkg : Package.build(pkg, skip_fetch=False),
+        all     = lambda pkg : build_cached(pkg, skip_fetch=False),
         fetch   = lambda pkg : pkg.fetch(),
-        nofetch = lambda pkg : Package.build(pkg, skip_fetch=True))
+        nofetch = lambda pkg : build_cached(pkg, skip_fetch=True))
 
     # Build the packages, skipping the ones already done
     done_file = opt.build_root + "/done.txt"
     done = read_done(done_file)
+    done_lock = threading.Lock()
+
+    todo = []
+    for pkg in build:
+        name = pkg.__name__
+        if name in done and name != 'binarybuilder':
+            print("Package %s was already built, skipping" % name)
+            continue
+        todo.append(pkg)
+
+    def build_one(pkg):
+        if jobserver is not None and opt.mode != 'fetch':
+            # Hold a job slot for as long as the package is being built
+            with jobserver.slot():
+                build_pkg(pkg)
+        else:
+            build_pkg(pkg)
+
+    def build_pkg(pkg):
+        name = pkg.__name__
+        print("\n========== Building: %s ==========" % name)
+        # Talking to servers is tried again by the RetryPolicy, in the
+        # stages which do it. A failure to build is final.
+        try:
+            modes[opt.mode](pkg(build_env.copy_set_default()))
+        except Exception as e:
+            print("Failed to build %s: %s" % (name, str(e)))
+            raise
+        if opt.mode == 'fetch':
+            # Only the sources are there, it is not built yet
+            return
+        # Mark as done
+        chksum = get_chksum(name)
+        with done_lock:
+            done[name] = chksum
+            # Save the status after each package was built,
+            # in case the process gets interrupted.
+            write_done(done, done_file)
+
+    # All make, ninja and bjam processes take their jobs from one pool,
+    # so building several packages at once does not oversubscribe the cpus.
+    jobserver = None
+    if opt.jobserver:
+        jobserver = JobServer(opt.threads, build_env['MISC_DIR'])
+        atexit.register(jobserver.close)
+        set_jobserver(jobserver)
+
+    if opt.jobs > 1:
+        info('Building up to %d packages at the same time' % opt.jobs)
     try:
-        for pkg in build:
-            name = pkg.__name__
-            if name in done and name != 'binarybuilder':
-                print("Package %s was already built, skipping" % name)
-                continue
-            print("\n========== Building: %s ==========" % name)
-            # Make several attempts, perhaps the servers are down.
-            num=10
-            for i in range(0,num):
-                try:
-                    # Build
-                    modes[opt.mode](pkg(build_env.copy_set_default()))
-                    # Mark as done
-                    name = pkg.__name__
-                    chksum = get_chksum(name)
-                    done[name] = chksum
-                    # Save the status after each package was built,
-                    # in case the process gets interrupted.
-                    write_done(done, done_file)
-                    break
-                except Exception as e:
-                    print("Failed to build %s in attempt %d %s" %
-                          (name, i, str(e)))
-                    raise
-                    #if i < num-1:
-                    #    print("Sleep for 60 seconds and try again")
-                    #    time.sleep(60)
-                    #else:
-                    #    raise
-
+        if opt.mode == 'fetch':
+            # Fetching needs no order, get all the sources at once,
+            # without hammering any one server.
+            run_pool(todo, build_one, jobs=opt.fetch_jobs,
+                     key=lambda pkg: pkg.source_host(), per_key=opt.fetch_per_host)
+        else:
+            run_graph(todo, build_one, jobs=opt.jobs)
     except Exception as e:
         die(e)
 
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+# A minimal HTTP server for the shared artifact cache of build.py
+# (--remote-cache http://host:port/). It answers GET and HEAD with the
+# files in a directory and saves the body of PUT requests there. It
+# does no authentication, so only run it on a trusted network, or for
+# testing on one machine:
+#
+#   ./cache-server.py --dir /tmp/remote-cache --port 8765 &
+#   ./build.py --remote-cache http://localhost:8765/ ...
+#
+# It also serves byte ranges and can be slowed down with --throttle,
+# so a few of them can stand in for faster and slower source mirrors.
+
+from __future__ import print_function
+
+import sys
+import os
+import os.path as P
+import re
+import tempfile
+import time
+from optparse import OptionParser
+
+if sys.version_info < (3, 0, 0):
+    # Python 2
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote
+else:
+    # Python 3
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import unquote
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class CacheHandler(BaseHTTPRequestHandler):
+    root = None
+    throttle = 0 # Bytes per second to send at most, 0 for no limit
+
+    def _path(self):
+        '''The file a request is for, or None if it is outside the root'''
+        name = unquote(self.path.split('?', 1)[0]).lstrip('/')
+        path = P.realpath(P.join(self.root, name))
+        if not path.startswith(self.root + os.sep):
+            return None
+        return path
+
+    def _head(self, send_body):
+        path = self._path()
+        if path is None or not P.isfile(path):
+            self.send_error(404)
+            return
+        with open(path, 'rb') as f:
+            size  = os.fstat(f.fileno()).st_size
+            start = 0
+            end   = size - 1
+            m = re.match(r'^bytes=(\d*)-(\d*)$', self.headers.get('Range', ''))
+            if m and (m.group(1) or m.group(2)):
+                if m.group(1):
+                    start = int(m.group(1))
+                    if m.group(2):
+                        end = min(int(m.group(2)), end)
+                else: # The last bytes of the file
+                    start = max(size - int(m.group(2)), 0)
+                if start >= size:
+                    self.send_response(416)
+                    self.send_header('Content-Range', 'bytes */%d' % size)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+            else:
+                self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(end + 1 - start))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.end_headers()
+            if not send_body:
+                return
+            f.seek(start)
+            left = end + 1 - start
+            block_size = 1 << 20
+            if self.throttle:
+                block_size = max(self.throttle // 10, 1)
+            while left > 0:
+                block = f.read(min(left, block_size))
+                if not block:
+                    break
+                self.wfile.write(block)
+                left -= len(block)
+                if self.throttle:
+                    time.sleep(len(block) / float(self.throttle))
+
+    def do_HEAD(self):
+        self._head(False)
+
+    def do_GET(self):
+        self._head(True)
+
+    def do_PUT(self):
+        path = self._path()
+        length = self.headers.get('Content-Length')
+        if path is None or length is None:
+            self.send_error(400)
+            return
+        length = int(length)
+        dirname = P.dirname(path)
+        if not P.isdir(dirname):
+            os.makedirs(dirname)
+        # Write to a temporary file first, so readers never see a partial one
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while length > 0:
+                    block = self.rfile.read(min(length, 1 << 20))
+                    if not block:
+                        raise IOError('Connection closed')
+                    f.write(block)
+                    length -= len(block)
+            os.chmod(tmp, 0o644)
+            os.rename(tmp, path)
+        except:
+            os.unlink(tmp)
+            raise
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('--dir',  dest='dir',  default='./remote-cache', help='Where to keep the cached files')
+    parser.add_option('--bind', dest='bind', default='127.0.0.1',      help='Address to listen on')
+    parser.add_option('--port', dest='port', default=8765, type='int', help='Port to listen on')
+    parser.add_option('--throttle', dest='throttle', default=0, type='int', help='Send at most this many kB per second on each request, to stand in for a slow mirror')
+    parser.add_option('--quiet', action='store_true', dest='quiet', default=False, help='Do not log requests')
+
+    (opt, args) = parser.parse_args()
+
+    CacheHandler.root = P.realpath(opt.dir)
+    if not P.isdir(CacheHandler.root):
+        os.makedirs(CacheHandler.root)
+    CacheHandler.throttle = opt.throttle * 1024
+    if opt.quiet:
+        CacheHandler.log_message = lambda *args: None
+
+    server = ThreadingHTTPServer((opt.bind, opt.port), CacheHandler)
+    print('Serving %s on http://%s:%d/' % (CacheHandler.root, opt.bind, opt.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -14,6 +14,7 @@ import os.path as P
 from optparse import OptionParser
 from BinaryBuilder import die, program_exists
 from BinaryDist import get_platform, required_libs, get_python_version
+from InstallManifest import installed_kinds
 from glob import glob
 
 # These are the libraries we're allowed to get from the base system.
@@ -215,6 +216,9 @@ if __name__ == '__main__':
         
     INSTALLDIR = DistPrefix(installdir)
     mgr = DistManager(wrapper_file, INSTALLDIR, opt.asp_deps_dir)
+    # The files build.py installed were looked at as they were installed,
+    # their kinds are in the install manifests.
+    mgr.kinds.update(installed_kinds(INSTALLDIR))
     
     try:
         SEARCHPATH = [INSTALLDIR.lib(), 